@@ -1,36 +1,37 @@
-from pydigital.utils import sextend
+from array import array
+from engine_util import signed
 
 aluNumToOp = ['x','xor','cp','sltu',   # 0..3
               'and', 'add', 'slt', 'sra', # 4..7
               'sub', 'srl', 'sll', 'or']  # 8..11
 
+# all results are wrapped to 32 bits, operands can be unsigned or python signed ints
+MASK = 0xffffffff
+
+# one function per ALU_fun, the table is indexed by the control signal
+alu_ops = [
+    lambda a, b: 0,                                     # x
+    lambda a, b: (a ^ b) & MASK,                        # xor
+    lambda a, b: a & MASK,                              # cp
+    lambda a, b: 1 if a & MASK < b & MASK else 0,       # sltu
+    lambda a, b: a & b & MASK,                          # and
+    lambda a, b: (a + b) & MASK,                        # add
+    lambda a, b: 1 if signed(a & MASK) < signed(b & MASK) else 0,  # slt
+    lambda a, b: (signed(a & MASK) >> (b & 0x1f)) & MASK,         # sra
+    lambda a, b: (a - b) & MASK,                        # sub
+    lambda a, b: (a & MASK) >> (b & 0x1f),              # srl
+    lambda a, b: (a << (b & 0x1f)) & MASK,              # sll
+    lambda a, b: (a | b) & MASK,                        # or
+]
+
 # define a function to implement ALU
 def alu(op1, op2, alu_fun):
-    # figure out the op and perform the respective op
-    if alu_fun == 1: # xor
-        return op1 ^ op2
-    if alu_fun == 2: # cp
-        return op1
-    if alu_fun == 3: # sltu
-        return op1 * (2**op2)
-    if alu_fun == 4: # and
-        return op1 & op2
-    if alu_fun == 5: # add
-        return op1 + op2
-    if alu_fun == 6: # slt
-        return 1 if op1 < op2 else 0
-    if alu_fun == 7: # sra
-        return op1 >> op2
-    if alu_fun == 8: # sub
-        return op1 - op2
-    if alu_fun == 9: # srl
-        return op1 >> op2
-    if alu_fun == 10: # sll
-        return sextend(op1 << op2)
-    if alu_fun == 11: # or
-        return op1 | op2
-    # else the output is 0
-    return 0
+    "perform the alu_fun operation, the result is an unsigned 32-bit value"
+    return alu_ops[alu_fun](op1, op2)
+
+def alu_batch(op1s, op2s, alu_fun):
+    "apply one alu_fun across sequences of operands, returns an array of unsigned 32-bit results"
+    return array('I', map(alu_ops[alu_fun], op1s, op2s))
 
 # testbench for alu
 if __name__=="__main__":
@@ -38,3 +39,9 @@ if __name__=="__main__":
     for i in range(len(aluNumToOp)):
         out = alu(op1, op2, i)
         print(f"{op1:x}\t{aluNumToOp[i]}\t{op2:x}\t=\t{out:x}")
+    # the 32-bit corner cases
+    op1 = -8; op2 = 0x1
+    for i in range(len(aluNumToOp)):
+        out = alu(op1, op2, i)
+        print(f"{op1 & MASK:x}\t{aluNumToOp[i]}\t{op2:x}\t=\t{out:x}")
+    print(list(alu_batch([1, 2, 0xffffffff], [1, 2, 1], 5)))
@@ -0,0 +1,186 @@
+"""
+bench.py
+========
+Guest benchmark suite for the onestage simulator.
+
+Every benchmark (riscv_isa/programs/benchmarks by default) runs in each
+execution mode: on the engines of the Simulator and on the cycle by cycle
+datapath of onestage_elf.py, with its debug output (datapath), silent (-s)
+and with the fast muxes (-s -f). A run happens in a fresh process so its
+peak RSS is its own, each benchmark is repeated and the median wall time is
+reported with the instructions retired and the host MIPS.
+
+The datapath runs onestage_elf.py as a subprocess, so its time includes
+starting python and loading the elf, it always runs to the end (no -limit)
+and its instructions retired are counted on the functional engine.
+
+The results can be saved as a JSON baseline (-save=file) and a later run
+compared against it (-baseline=file), a benchmark whose MIPS dropped by more
+than the threshold (-threshold=percent) is flagged as a regression.
+
+usage: python bench.py [bench_dir or elfs] [-engines=functional,blocks,jit,fast,...]
+                       [-n=repeats] [-limit=N] [-timeout=S] [-save=file.json]
+                       [-baseline=file.json] [-threshold=percent]
+"""
+import os, sys, json, time, statistics, subprocess
+import multiprocessing
+from simulator import Simulator, ENGINES
+
+try:
+    import resource
+except ImportError:
+    # not on windows, peak rss is not reported
+    resource = None
+
+BENCH_DIR = os.path.join('riscv_isa', 'programs', 'benchmarks')
+# the datapath modes, the flags they pass to onestage_elf.py
+ONESTAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'onestage_elf.py')
+DATAPATH = {'datapath': (), 'silent': ('-s',), 'fast': ('-s', '-f')}
+MODES = list(ENGINES) + list(DATAPATH)
+
+# defaults for the runs of each benchmark
+REPEATS = 3
+LIMIT = 10**8
+TIMEOUT = 600
+THRESHOLD = 10.0
+
+def peak_rss(children = False):
+    "peak resident set size of this process (or its children) in kilobytes, None if unknown"
+    if resource == None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN if children else
+                             resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macos bytes
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+def run_once(args):
+    "run one benchmark to completion, returns (status, exit code, instret, seconds, peak rss)"
+    path, engine, limit, timeout = args
+    if engine in DATAPATH:
+        return run_datapath(path, engine, timeout)
+    sim = Simulator(engine).load_elf(path)
+    r = sim.run(max_instructions = limit, timeout = timeout)
+    return r.status, r.exit_code, r.instret, r.elapsed, peak_rss()
+
+def run_datapath(path, mode, timeout = None):
+    "run one benchmark on the datapath, returns the same as run_once without the instret"
+    cmd = [sys.executable, ONESTAGE, path, *DATAPATH[mode]]
+    start = time.perf_counter()
+    try:
+        p = subprocess.run(cmd, stdout = subprocess.DEVNULL, timeout = timeout)
+        status = 'exit' if p.returncode >= 0 else 'error'
+        code = p.returncode
+    except subprocess.TimeoutExpired:
+        status, code = 'timeout', None
+    return status, code, None, time.perf_counter() - start, peak_rss(children = True)
+
+def bench(path, engine, repeats = REPEATS, limit = LIMIT, timeout = TIMEOUT):
+    "run a benchmark repeats times on engine, returns its result as a dict"
+    runs = []
+    # one process per run so the rss and the engine caches start fresh
+    with multiprocessing.Pool(1, maxtasksperchild = 1) as pool:
+        for _ in range(repeats):
+            runs.append(pool.apply(run_once, ((path, engine, limit, timeout),)))
+    status, code, instret = runs[-1][:3]
+    if engine in DATAPATH and status == 'exit':
+        # the datapath retires what the functional engine does
+        instret = Simulator().load_elf(path).run(timeout = timeout).instret
+    instret = instret or 0
+    elapsed = statistics.median(r[3] for r in runs)
+    rss = [r[4] for r in runs if r[4] != None]
+    return {
+        'name': os.path.basename(path),
+        'engine': engine,
+        'status': status,
+        'exit_code': code,
+        'instret': instret,
+        'time': elapsed,
+        'times': [r[3] for r in runs],
+        'mips': instret / elapsed / 1e6 if elapsed else 0.0,
+        'peak_rss_kb': max(rss) if rss else None,
+    }
+
+def compare(results, baseline, threshold = THRESHOLD):
+    """
+    compare results against a baseline, sets 'change' (percent MIPS change)
+    and 'regressed' on each result found in the baseline, returns the regressions
+    """
+    old = {(b['name'], b['engine']): b for b in baseline['results']}
+    regressions = []
+    for r in results:
+        b = old.get((r['name'], r['engine']))
+        if b == None or not b['mips']:
+            continue
+        r['change'] = 100.0 * (r['mips'] - b['mips']) / b['mips']
+        r['regressed'] = r['change'] < -threshold
+        if r['regressed']:
+            regressions.append(r)
+    return regressions
+
+def report(results):
+    "print a table of the results"
+    print(f"{'benchmark':20s} {'mode':10s} {'status':>8s} {'instret':>10s} {'time (s)':>9s} "
+          f"{'MIPS':>7s} {'rss (kB)':>9s} {'change':>8s}")
+    for r in results:
+        rss = '-' if r['peak_rss_kb'] == None else str(r['peak_rss_kb'])
+        change = f"{r['change']:+.1f}%" if 'change' in r else '-'
+        flag = '  REGRESSED' if r.get('regressed') else ''
+        print(f"{r['name']:20s} {r['engine']:10s} {r['status']:>8s} {r['instret']:10d} "
+              f"{r['time']:9.3f} {r['mips']:7.3f} {rss:>9s} {change:>8s}{flag}")
+
+if __name__=="__main__":
+    paths = []
+    engines = list(MODES)
+    repeats = REPEATS
+    limit = LIMIT
+    timeout = TIMEOUT
+    threshold = THRESHOLD
+    save = baseline = None
+    for arg in sys.argv[1:]:
+        if arg.startswith('-engines='):
+            engines = arg.split('=', 1)[1].split(',')
+            for engine in engines:
+                if engine not in MODES:
+                    exit(f"ERROR: unknown mode {engine}, use one of {', '.join(MODES)}")
+        elif arg.startswith('-n='):
+            repeats = max(1, int(arg.split('=', 1)[1]))
+        elif arg.startswith('-limit='):
+            limit = int(arg.split('=', 1)[1]) or None
+        elif arg.startswith('-timeout='):
+            timeout = float(arg.split('=', 1)[1]) or None
+        elif arg.startswith('-threshold='):
+            threshold = float(arg.split('=', 1)[1])
+        elif arg.startswith('-save='):
+            save = arg.split('=', 1)[1]
+        elif arg.startswith('-baseline='):
+            baseline = arg.split('=', 1)[1]
+        elif arg.startswith('-'):
+            exit(f"ERROR: unknown option {arg}")
+        elif os.path.isdir(arg):
+            paths += [os.path.join(arg, f) for f in sorted(os.listdir(arg))]
+        else:
+            paths.append(arg)
+    if not paths:
+        paths = [os.path.join(BENCH_DIR, f) for f in sorted(os.listdir(BENCH_DIR))]
+
+    results = []
+    for path in paths:
+        for engine in engines:
+            results.append(bench(path, engine, repeats, limit, timeout))
+            r = results[-1]
+            print(f"{r['name']} on {engine}: {r['mips']:.3f} MIPS", file=sys.stderr)
+
+    regressions = []
+    if baseline:
+        with open(baseline) as f:
+            regressions = compare(results, json.load(f), threshold)
+    report(results)
+
+    if save:
+        with open(save, 'w') as f:
+            json.dump({'repeats': repeats, 'python': sys.version.split()[0],
+                       'results': results}, f, indent = 2)
+    if regressions:
+        print(f"{len(regressions)} regression(s) past {threshold}%: " +
+              ', '.join(f"{r['name']} ({r['engine']})" for r in regressions))
+        exit(1)
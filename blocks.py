@@ -0,0 +1,604 @@
+"""
+blocks.py
+=========
+Basic-block translation engine for the onestage simulator.
+
+Guest code is split into basic blocks that end at a branch, jal, jalr or
+ecall. Each block is translated once into a single python callable built
+from pre-bound closures (one per instruction), so running it skips fetch,
+decode, the muxes and the control table entirely. The callable returns
+the next pc.
+
+Blocks are cached by their start pc and chained directly to the blocks
+they branch to. Stores into a page that code was translated from take a
+slow path which drops the blocks covering the stored bytes (data often
+shares the last code page, dropping the whole page would thrash), fence.i
+drops all of them.
+
+A csr instruction is a block of its own. It is cached apart from the
+others (in slow) and never chained to, so it always runs from the lookup
+path where instret is brought up to date for the counter csrs.
+
+With a TraceBuffer (tracer.py) the engine runs a separate loop that picks
+per block: a block the Trigger can't start in runs its plain callable while
+no trace is in progress, the others step through one closure per
+instruction and record the ones the trigger selects.
+
+Registers are kept in the RegFile as unsigned 32-bit values, an ArrayRegFile
+stores them that way already.
+"""
+from riscv_isa import BadInstruction
+from riscv_isa.decode_table import decode
+from htif import Halt
+from csrfile import CSRFile
+from engine_util import CSRS, signed, unsigned_regs
+
+# translated code is tracked (and invalidated) per 4 KiB page
+PAGE_BITS = 12
+# longest block, in instructions
+MAX_BLOCK = 64
+MASK = 0xffffffff
+
+# instructions that end a basic block, csrs also start one
+BRANCHES = ('beq', 'bne', 'blt', 'bge', 'bltu', 'bgeu')
+TERMINATORS = BRANCHES + CSRS + ('jal', 'jalr', 'ecall', 'fence.i')
+# instructions without an architectural effect here
+NOPS = ('fence', 'ebreak', 'mret')
+
+class Block:
+    "a translated basic block of count instructions starting at pc"
+    __slots__ = ('pc', 'count', 'run', 'instrs', 'links', 'valid', 'hits')
+    def __init__(self, pc, count, run, instrs = ()):
+        self.pc = pc
+        self.count = count
+        self.run = run       # callable that executes the block and returns the next pc
+        self.instrs = instrs # the decoded instructions it was translated from
+        self.links = {}      # next pc -> successor Block
+        self.valid = True
+        self.hits = 0        # executions, only counted by the jit tier
+    def __str__(self):
+        return f"Block[{self.pc:08x}:{self.pc + 4*self.count:08x}] ({self.count})"
+
+class BlockEngine:
+    "runs a program by translating its basic blocks into python callables"
+    def __init__(self, mem, rf, host, max_block = MAX_BLOCK, trace = None, trigger = None):
+        """
+        mem is the sodor style Memory wrapping the system ELFMemory,
+        rf the RegFile and host the HTIF servicing ecalls and syscalls,
+        blocks are cut after max_block instructions, trace is an optional
+        TraceBuffer recording the retired instructions the optional Trigger
+        selects
+        """
+        self.max_block = max_block
+        self.mem = mem.mem
+        self.rf = rf
+        self.host = host
+        # registers are unsigned 32-bit ints, undefined ones read as zero
+        self.regs = unsigned_regs(rf)
+        self.blocks = {}     # start pc -> Block
+        self.slow = {}       # the same for csr blocks, they read the retire count
+        self.pages = {}      # page number -> blocks translated from that page
+        # stores to these pages take the slow path in store_hook
+        self.watched = set()
+        if host.trigger != None:
+            self.watched.add(host.trigger >> PAGE_BITS)
+        # statistics
+        self.instret = 0
+        self.translated = 0
+        self.invalidated = 0
+        self.csrs = CSRFile(lambda: self.instret)
+        # tracing, the blocks the trigger covers and their per instruction steps
+        self.trace = trace
+        self.trigger = trigger
+        self.marked = set()
+        self.steps = {}
+
+    def run(self, pc, limit = None):
+        """
+        run from pc until the program ends (returns None) or limit
+        instructions retired (returns the next pc), raises Halt when the guest exits
+        """
+        if self.trace != None:
+            return self.run_traced(pc, limit)
+        slow = self.slow
+        blk = self.lookup(pc)
+        n = self.instret
+        stop = float('inf') if limit == None else n + limit
+        try:
+            while blk != None:
+                if n + blk.count > stop:
+                    # the limit falls inside the block
+                    pc = self.partial(blk, stop - n)
+                    n = stop
+                    return pc
+                npc = blk.run()
+                n += blk.count
+                # follow the chain, fall back to the cache (or translate)
+                nxt = blk.links.get(npc)
+                if nxt == None or not nxt.valid:
+                    # csr blocks read the retire count
+                    self.instret = n
+                    nxt = self.lookup(npc)
+                    if nxt != None and npc not in slow:
+                        blk.links[npc] = nxt
+                blk = nxt
+        except Halt as h:
+            # only count the block up to the instruction that halted
+            n += (h.pc - blk.pc) // 4 + 1
+            raise
+        finally:
+            self.instret = n
+
+    def run_traced(self, pc, limit = None):
+        "run like run, stepping through the blocks that can be traced"
+        trigger = self.trigger
+        marked = self.marked
+        slow = self.slow
+        blk = self.lookup(pc)
+        n = self.instret
+        stop = float('inf') if limit == None else n + limit
+        try:
+            while blk != None:
+                if n + blk.count > stop:
+                    if blk.pc in marked or trigger != None and trigger.tracking:
+                        pc = self.step(blk, stop - n)
+                    else:
+                        pc = self.partial(blk, stop - n)
+                    n = stop
+                    return pc
+                if blk.pc in marked or trigger != None and trigger.tracking:
+                    npc = self.step(blk)
+                    if trigger != None and trigger.done:
+                        # nothing left to trace, all blocks run at full speed
+                        marked.clear()
+                else:
+                    npc = blk.run()
+                n += blk.count
+                nxt = blk.links.get(npc)
+                if nxt == None or not nxt.valid:
+                    self.instret = n
+                    nxt = self.lookup(npc)
+                    if nxt != None and npc not in slow:
+                        blk.links[npc] = nxt
+                blk = nxt
+        except Halt as h:
+            n += (h.pc - blk.pc) // 4 + 1
+            raise
+        finally:
+            self.instret = n
+
+    def step(self, blk, count = None):
+        """
+        run a block (or only its first count instructions) one instruction at
+        a time, recording the traced ones, returns the next pc
+        """
+        steps = self.steps.get(blk)
+        if steps == None:
+            steps = []
+            for instr in blk.instrs:
+                term = instr.instr in TERMINATORS
+                ctrl = instr.ctrl
+                steps.append((instr, self.terminator(instr) if term else self.op(instr), term,
+                              ctrl != None and ctrl.mem_em))
+            self.steps[blk] = steps
+        r = self.regs
+        record = self.trace.record
+        check = None if self.trigger == None else self.trigger.check
+        npc = blk.pc + 4 * blk.count
+        if count != None:
+            steps = steps[:count]
+            npc = blk.pc + 4 * count
+        for instr, fn, term, mem in steps:
+            # checked first, a call at the start pc changes ra
+            traced = check == None or check(instr.pc, r[1])
+            # the address before the closure, a load can overwrite rs1
+            addr = (r[instr.rs1] + instr.imm) & MASK if mem else 0
+            try:
+                if term:
+                    npc = fn()
+                elif fn != None:
+                    fn()
+            except Halt:
+                if traced:
+                    record(instr.pc, instr.val, 0, addr)
+                raise
+            if traced:
+                record(instr.pc, instr.val, r[instr.rd] if instr.rd else 0, addr)
+        return npc
+
+    def partial(self, blk, count):
+        "run the first count instructions of blk, short of its terminator, returns the next pc"
+        # translated one instruction at a time, the tail of a run isn't cached
+        for instr in blk.instrs[:count]:
+            op = self.op(instr)
+            if op != None:
+                op()
+        return blk.pc + 4 * count
+
+    def lookup(self, pc):
+        "return the block starting at pc, translating it if needed (None at the end of the program)"
+        blk = self.blocks.get(pc)
+        if blk == None:
+            blk = self.slow.get(pc)
+            if blk == None:
+                blk = self.translate(pc)
+        return blk
+
+    def translate(self, pc):
+        "decode the basic block at pc and build its callable"
+        mem = self.mem
+        if mem[pc] == 0:
+            # the program ends at a zero word
+            return None
+        page = pc >> PAGE_BITS
+        instrs = []
+        addr = pc
+        while True:
+            try:
+                instr = decode(mem[addr], addr)
+            except KeyError:
+                if not instrs:
+                    raise BadInstruction(f"Cannot decode {mem[addr]:08x} at {addr:08x}")
+                break
+            if instr.instr in CSRS and instrs:
+                break
+            instrs.append(instr)
+            addr += 4
+            if instr.instr in TERMINATORS or len(instrs) == self.max_block \
+                or addr >> PAGE_BITS != page:
+                break
+            try:
+                if mem[addr] == 0:
+                    break
+            except IndexError:
+                break
+
+        ops = []
+        term = None
+        for instr in instrs:
+            if instr.instr in TERMINATORS:
+                term = self.terminator(instr)
+            else:
+                op = self.op(instr)
+                if op != None:
+                    ops.append(op)
+        ops = tuple(ops)
+
+        if term == None:
+            def run(ops=ops, npc=addr):
+                for op in ops:
+                    op()
+                return npc
+        elif not ops:
+            run = term
+        else:
+            def run(ops=ops, term=term):
+                for op in ops:
+                    op()
+                return term()
+
+        blk = Block(pc, len(instrs), run, tuple(instrs))
+        if self.trace != None and (self.trigger == None or self.trigger.covers(pc, addr)):
+            self.marked.add(pc)
+        if instrs[0].instr in CSRS:
+            # never chained, links to it look it up again
+            self.slow[pc] = blk
+        else:
+            self.blocks[pc] = blk
+        self.pages.setdefault(page, []).append(blk)
+        self.watched.add(page)
+        self.translated += 1
+        return blk
+
+    def drop(self, blk):
+        "remove a block from the cache, chained links to it are dead"
+        blk.valid = False
+        if self.blocks.get(blk.pc) is blk:
+            del self.blocks[blk.pc]
+        elif self.slow.get(blk.pc) is blk:
+            del self.slow[blk.pc]
+        self.steps.pop(blk, None)
+        self.invalidated += 1
+
+    def invalidate(self, addr, size):
+        "drop the blocks overlapping the size bytes written at addr, returns whether there were any"
+        page = addr >> PAGE_BITS
+        blks = self.pages.get(page)
+        if not blks:
+            return False
+        end = addr + size
+        hit = [blk for blk in blks if blk.pc < end and addr < blk.pc + 4 * blk.count]
+        if not hit:
+            # data sharing a code page
+            return False
+        for blk in hit:
+            self.drop(blk)
+        keep = [blk for blk in blks if blk not in hit]
+        self.pages[page] = keep
+        if not keep:
+            self.invalidate_page(page)
+        return True
+
+    def invalidate_page(self, page):
+        "drop all blocks translated from page"
+        for blk in self.pages.pop(page, ()):
+            self.drop(blk)
+        if self.host.trigger == None or page != self.host.trigger >> PAGE_BITS:
+            self.watched.discard(page)
+
+    def flush(self):
+        "drop every translated block (fence.i)"
+        for page in list(self.pages):
+            self.invalidate_page(page)
+
+    def store_hook(self, addr, size, pc):
+        "slow path for stores to a watched page, returns whether translated code was dropped"
+        dropped = self.invalidate(addr, size)
+        if addr == self.host.trigger:
+            try:
+                self.host.syscall()
+            except Halt as h:
+                h.pc = pc
+                raise
+        return dropped
+
+    def op(self, instr):
+        "translate a non-terminating instruction into a closure, None if it has no effect"
+        name = instr.instr
+        if name in NOPS or instr.rd == 0:
+            # x0 is hardwired, nothing to write
+            return None
+        try:
+            build = _ops[name]
+        except KeyError:
+            raise BadInstruction(f"{name} at {instr.pc:08x} is not supported")
+        return build(self, instr)
+
+    def terminator(self, instr):
+        "translate a block terminator into a closure returning the next pc"
+        return _ops[instr.instr](self, instr)
+
+    def __str__(self):
+        return f"Blocks: {self.translated} translated, {self.invalidated} invalidated, " \
+               f"{len(self.blocks)} cached, {self.instret} instructions retired"
+
+# --- closure builders, one per mnemonic ---
+# each takes the engine and the decoded instruction and returns a closure
+# with the register numbers and immediates pre-bound
+
+def _rr(f):
+    "builder for register-register alu ops from f(a, b) -> unmasked result"
+    def build(e, i):
+        r = e.regs; rd = i.rd; rs1 = i.rs1; rs2 = i.rs2
+        def op():
+            r[rd] = f(r[rs1], r[rs2]) & MASK
+        return op
+    return build
+
+def _add(e, i):
+    r = e.regs; rd = i.rd; rs1 = i.rs1; rs2 = i.rs2
+    def op():
+        r[rd] = (r[rs1] + r[rs2]) & MASK
+    return op
+
+def _sub(e, i):
+    r = e.regs; rd = i.rd; rs1 = i.rs1; rs2 = i.rs2
+    def op():
+        r[rd] = (r[rs1] - r[rs2]) & MASK
+    return op
+
+def _addi(e, i):
+    r = e.regs; rd = i.rd; rs1 = i.rs1; imm = i.imm
+    if rs1 == 0:
+        val = imm & MASK
+        def op():
+            r[rd] = val
+    else:
+        def op():
+            r[rd] = (r[rs1] + imm) & MASK
+    return op
+
+def _ri(f):
+    "builder for register-immediate alu ops from f(a, imm) -> unmasked result"
+    def build(e, i):
+        r = e.regs; rd = i.rd; rs1 = i.rs1; imm = i.imm
+        def op():
+            r[rd] = f(r[rs1], imm) & MASK
+        return op
+    return build
+
+def _logic_i(kind):
+    "andi/ori/xori with the immediate pre-masked to 32 bits"
+    def build(e, i):
+        r = e.regs; rd = i.rd; rs1 = i.rs1; imm = i.imm & MASK
+        if kind == 'and':
+            def op():
+                r[rd] = r[rs1] & imm
+        elif kind == 'or':
+            def op():
+                r[rd] = r[rs1] | imm
+        else:
+            def op():
+                r[rd] = r[rs1] ^ imm
+        return op
+    return build
+
+def _shift_i(kind):
+    "slli/srli/srai with the shift amount pre-decoded"
+    def build(e, i):
+        r = e.regs; rd = i.rd; rs1 = i.rs1; sh = i.imm & 0x1f
+        if kind == 'sll':
+            def op():
+                r[rd] = (r[rs1] << sh) & MASK
+        elif kind == 'srl':
+            def op():
+                r[rd] = r[rs1] >> sh
+        else:
+            def op():
+                r[rd] = (((r[rs1] ^ 0x80000000) - 0x80000000) >> sh) & MASK
+        return op
+    return build
+
+def _lui(e, i):
+    r = e.regs; rd = i.rd; val = i.imm & MASK
+    def op():
+        r[rd] = val
+    return op
+
+def _auipc(e, i):
+    r = e.regs; rd = i.rd; val = (i.pc + i.imm) & MASK
+    def op():
+        r[rd] = val
+    return op
+
+def _load(size, signed):
+    "loads of size bytes, sign extended to 32 bits when signed"
+    sign = 1 << (8 * size - 1)
+    def build(e, i):
+        r = e.regs; rd = i.rd; rs1 = i.rs1; imm = i.imm; load = e.mem.load
+        if signed and size < 4:
+            def op():
+                r[rd] = ((load((r[rs1] + imm) & MASK, size) ^ sign) - sign) & MASK
+        else:
+            def op():
+                r[rd] = load((r[rs1] + imm) & MASK, size)
+        return op
+    return build
+
+def _store(size):
+    "stores write size bytes and divert to the slow path on watched pages"
+    def build(e, i):
+        r = e.regs; rs1 = i.rs1; rs2 = i.rs2; imm = i.imm; store = e.mem.store
+        watched = e.watched; hook = e.store_hook; pc = i.pc
+        def op():
+            addr = (r[rs1] + imm) & MASK
+            store(addr, r[rs2], size)
+            if addr >> PAGE_BITS in watched:
+                hook(addr, size, pc)
+        return op
+    return build
+
+def _branch(cond):
+    "builder for conditional branches, cond(a, b) on unsigned register values"
+    def build(e, i):
+        r = e.regs; rs1 = i.rs1; rs2 = i.rs2
+        taken = (i.pc + i.imm) & MASK; fall = i.pc + 4
+        def term():
+            return taken if cond(r[rs1], r[rs2]) else fall
+        return term
+    return build
+
+def _jal(e, i):
+    r = e.regs; rd = i.rd; target = (i.pc + i.imm) & MASK; link = i.pc + 4
+    if rd == 0:
+        def term():
+            return target
+    else:
+        def term():
+            r[rd] = link
+            return target
+    return term
+
+def _jalr(e, i):
+    r = e.regs; rd = i.rd; rs1 = i.rs1; imm = i.imm; link = i.pc + 4
+    def term():
+        target = (r[rs1] + imm) & 0xfffffffe
+        if rd:
+            r[rd] = link
+        return target
+    return term
+
+def _ecall(e, i):
+    r = e.regs; ecall = e.host.ecall; pc = i.pc; fall = i.pc + 4
+    def term():
+        try:
+            ecall(r[10], r[11], r[17])
+        except Halt as h:
+            h.pc = pc
+            raise
+        return fall
+    return term
+
+def _csr(e, i):
+    r = e.regs; rd = i.rd; rs1 = i.rs1; name = i.instr; addr = i.val >> 20
+    execute = e.csrs.execute; fall = i.pc + 4
+    imm = name.endswith('i')
+    def term():
+        old = execute(name, addr, rs1, rs1 if imm else r[rs1])
+        if rd:
+            r[rd] = old
+        return fall
+    return term
+
+def _fence_i(e, i):
+    flush = e.flush; fall = i.pc + 4
+    def term():
+        flush()
+        return fall
+    return term
+
+_ops = {
+    'add': _add,
+    'sub': _sub,
+    'sll': _rr(lambda a, b: a << (b & 0x1f)),
+    'slt': _rr(lambda a, b: 1 if signed(a) < signed(b) else 0),
+    'sltu': _rr(lambda a, b: 1 if a < b else 0),
+    'xor': _rr(lambda a, b: a ^ b),
+    'srl': _rr(lambda a, b: a >> (b & 0x1f)),
+    'sra': _rr(lambda a, b: signed(a) >> (b & 0x1f)),
+    'or': _rr(lambda a, b: a | b),
+    'and': _rr(lambda a, b: a & b),
+    'addi': _addi,
+    'slti': _ri(lambda a, imm: 1 if signed(a) < imm else 0),
+    'sltiu': _ri(lambda a, imm: 1 if a < (imm & MASK) else 0),
+    'andi': _logic_i('and'),
+    'ori': _logic_i('or'),
+    'xori': _logic_i('xor'),
+    'slli': _shift_i('sll'),
+    'srli': _shift_i('srl'),
+    'srai': _shift_i('sra'),
+    'lui': _lui,
+    'auipc': _auipc,
+    'lb': _load(1, True),
+    'lh': _load(2, True),
+    'lw': _load(4, False),
+    'lbu': _load(1, False),
+    'lhu': _load(2, False),
+    'sb': _store(1),
+    'sh': _store(2),
+    'sw': _store(4),
+    'beq': _branch(lambda a, b: a == b),
+    'bne': _branch(lambda a, b: a != b),
+    'blt': _branch(lambda a, b: signed(a) < signed(b)),
+    'bge': _branch(lambda a, b: signed(a) >= signed(b)),
+    'bltu': _branch(lambda a, b: a < b),
+    'bgeu': _branch(lambda a, b: a >= b),
+    'jal': _jal,
+    'jalr': _jalr,
+    'ecall': _ecall,
+    'fence.i': _fence_i,
+    'csrrw': _csr, 'csrrs': _csr, 'csrrc': _csr,
+    'csrrwi': _csr, 'csrrsi': _csr, 'csrrci': _csr,
+}
+
+# testbench, run an elf and report the translation statistics and speed
+if __name__=="__main__":
+    import sys, time
+    from pydigital.memory import Memory
+    from pydigital.elfloader import load_elf
+    from regfile import ArrayRegFile
+    from htif import HTIF
+
+    if len(sys.argv) < 2:
+        exit("ERROR: input elf file not provided!")
+    mem, symbols = load_elf(sys.argv[1], quiet=True)
+    engine = BlockEngine(Memory(mem), ArrayRegFile(), HTIF(mem, symbols, sys.argv[1]))
+    start = time.perf_counter()
+    code = 0
+    try:
+        engine.run(symbols['_start'])
+    except Halt as h:
+        code = h.code
+    elapsed = time.perf_counter() - start
+    print(engine)
+    print(f"exit code {code}, {elapsed:.3f} s, {engine.instret / elapsed / 1e6:.3f} MIPS")
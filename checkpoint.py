@@ -0,0 +1,128 @@
+"""
+checkpoint.py
+=============
+Checkpoints of the complete architectural state of the onestage simulator.
+
+A checkpoint holds the pc, the retire count, the registers, the csrs (the
+counters as their current values) and every ELFMemory segment. The host
+interface keeps its state (tohost, fromhost) in guest memory, so the
+segments cover it. The file is a small binary header followed by the raw
+segment buffers, gzip compressed when the file name ends in .gz:
+
+    magic, version, pc, instret, segment count, elf path length, elf path
+    32 registers, 3 counters, csr count, (csr address, value) pairs
+    (begin address, length, data) per segment
+
+Restoring loads the elf the checkpoint was taken from and copies the
+buffers over its segments in place, so the memoryviews the engines hold on
+them stay valid. Simulator.restore and onestage_elf.py -restore both go
+through restore here. Long runs can be warm started after their
+initialization or a mid run state saved to bisect a difference from.
+"""
+import gzip, struct
+from collections import namedtuple
+
+MAGIC = b'RVCK'
+VERSION = 1
+HEADER = struct.Struct('<4sHIQHH')
+REGS = struct.Struct('<32I')
+COUNTERS = struct.Struct('<3Q')
+COUNT = struct.Struct('<H')
+CSR = struct.Struct('<HI')
+SEGMENT = struct.Struct('<II')
+MASK = 0xffffffff
+
+# counters holds the cycle, time and instret values, csrs the other csrs
+# (address -> value) and segments a tuple of (begin address, data)
+Checkpoint = namedtuple('Checkpoint',
+    ['elffile', 'pc', 'instret', 'regs', 'counters', 'csrs', 'segments'])
+
+def _open(path, mode):
+    "open a checkpoint file, gzip compressed if it ends in .gz"
+    if path.endswith('.gz'):
+        return gzip.open(path, mode, compresslevel = 1)
+    return open(path, mode)
+
+def snapshot(elffile, pc, instret, regs, csrs, mem):
+    """
+    the Checkpoint of a machine state, elffile is the program it runs,
+    regs the register values (undefined ones are saved as zero), csrs the
+    CSRFile and mem the ELFMemory
+    """
+    counters, values = csrs.save()
+    return Checkpoint(elffile, pc, instret, tuple((v or 0) & MASK for v in regs),
+        tuple(counters), dict(values), tuple((m.begin_addr, bytes(m.data)) for m in mem.mems))
+
+def save(path, ckpt):
+    "write a Checkpoint to path"
+    name = ckpt.elffile.encode()
+    with _open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, ckpt.pc, ckpt.instret, len(ckpt.segments), len(name)))
+        f.write(name)
+        f.write(REGS.pack(*ckpt.regs))
+        f.write(COUNTERS.pack(*ckpt.counters))
+        f.write(COUNT.pack(len(ckpt.csrs)))
+        f.write(b"".join(CSR.pack(addr, val) for addr, val in sorted(ckpt.csrs.items())))
+        for begin, data in ckpt.segments:
+            f.write(SEGMENT.pack(begin, len(data)))
+            f.write(data)
+
+def load(path):
+    "read the Checkpoint saved in path"
+    with _open(path, 'rb') as f:
+        read = lambda st: st.unpack(f.read(st.size))
+        magic, version, pc, instret, nsegs, length = read(HEADER)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} checkpoint")
+        elffile = f.read(length).decode()
+        regs = read(REGS)
+        counters = read(COUNTERS)
+        csrs = dict(CSR.iter_unpack(f.read(CSR.size * read(COUNT)[0])))
+        segments = []
+        for _ in range(nsegs):
+            begin, size = read(SEGMENT)
+            data = f.read(size)
+            if len(data) != size:
+                raise ValueError(f"{path} is truncated")
+            segments.append((begin, data))
+    return Checkpoint(elffile, pc, instret, regs, counters, csrs, tuple(segments))
+
+def restore_memory(ckpt, mem):
+    "copy the checkpoint segments over the matching segments of the ELFMemory mem"
+    layout = [(m.begin_addr, len(m.data)) for m in mem.mems]
+    if layout != [(begin, len(data)) for begin, data in ckpt.segments]:
+        raise ValueError("The checkpoint memory doesn't match the program's segments "
+                         "(a different elf or stack size)")
+    for m, (begin, data) in zip(mem.mems, ckpt.segments):
+        m.view[:] = data
+
+def restore(ckpt, mem, rf, csrs, now):
+    """
+    restore a Checkpoint into the ELFMemory mem, the register file rf and the
+    CSRFile csrs, the counters continue from a retire count of now, returns
+    the pc to continue at
+    """
+    restore_memory(ckpt, mem)
+    for n, val in enumerate(ckpt.regs):
+        rf.regs[n] = val
+    csrs.load(ckpt.counters, ckpt.csrs, now)
+    return ckpt.pc
+
+# testbench, checkpoint a program halfway and check the restored run ends the same
+if __name__=="__main__":
+    import sys, time
+    from simulator import Simulator
+    if len(sys.argv) < 2:
+        exit("ERROR: input elf file not provided!")
+    path = sys.argv[1]
+    full = Simulator().load_elf(path).run()
+    sim = Simulator().load_elf(path)
+    sim.run(max_instructions = full.instret // 2)
+    sim.checkpoint('/tmp/checkpoint.gz')
+    start = time.perf_counter()
+    warm = Simulator().restore('/tmp/checkpoint.gz')
+    print(f"restored at {warm.instret} instructions in {1e3 * (time.perf_counter() - start):.1f} ms")
+    rest = warm.run()
+    print(full)
+    print(rest)
+    assert (rest.status, rest.exit_code, rest.instret) == (full.status, full.exit_code, full.instret)
@@ -0,0 +1,123 @@
+"""
+csrfile.py
+==========
+Control and status registers for the onestage simulator.
+
+The addresses come from riscv_isa/csr_list.py. Ordinary csrs are a dict of
+values, unknown ones read as zero. The cycle, time and instret counters (and
+their machine mode and RV32 upper half aliases) are not stored: they are
+derived from the retire count of the engine when read, so running costs
+nothing per instruction. This core retires one instruction per cycle and
+time ticks with the cycles. Writing mcycle or minstret sets an offset.
+"""
+from riscv_isa.csr_list import csrs
+
+MASK = 0xffffffff
+
+# address -> csr name
+csr_names = dict(csrs)
+csr_addrs = {name: addr for addr, name in csrs}
+
+# the counters, address -> (counter, upper half)
+CYCLE, TIME, INSTRET = 0, 1, 2
+counters = {
+    0xC00: (CYCLE, False), 0xC01: (TIME, False), 0xC02: (INSTRET, False),
+    0xC80: (CYCLE, True), 0xC81: (TIME, True), 0xC82: (INSTRET, True),
+    0xB00: (CYCLE, False), 0xB02: (INSTRET, False),
+    0xB80: (CYCLE, True), 0xB82: (INSTRET, True),
+}
+
+# hart 0 of an RV32I machine
+RESET = {
+    0x301: 1 << 30 | 1 << ord('I') - ord('A'),  # misa
+    0xF11: 0, 0xF12: 0, 0xF13: 0, 0xF14: 0,     # mvendorid, marchid, mimpid, mhartid
+}
+
+class CSRFile:
+    def __init__(self, retired = lambda: 0):
+        """
+        Represents the csrs of a hart
+        retired returns the number of instructions retired before the one
+        running, the counters are derived from it
+        """
+        self.retired = retired
+        self.csrs = dict(RESET)
+        # counter -> value at a retire count of 0
+        self.offsets = [0, 0, 0]
+
+    def read(self, addr):
+        "the unsigned 32-bit value of the csr at addr"
+        if addr in counters:
+            which, high = counters[addr]
+            val = self.retired() + self.offsets[which]
+            return (val >> 32) & MASK if high else val & MASK
+        return self.csrs.get(addr, 0)
+
+    def write(self, addr, val):
+        "write the csr at addr, writes to read only csrs are dropped"
+        val &= MASK
+        if addr >> 10 == 0b11:
+            # read only (user counters and machine info), there are no traps
+            return
+        if addr in counters:
+            # keep the other half, the offset makes the counter read val now
+            which, high = counters[addr]
+            now = self.retired()
+            cur = now + self.offsets[which]
+            cur = val << 32 | cur & MASK if high else cur & ~MASK | val
+            self.offsets[which] = cur - now
+            return
+        self.csrs[addr] = val
+
+    def execute(self, name, addr, rs1, src):
+        """
+        run the csr instruction name on the csr at addr, rs1 is the rs1 field
+        and src its register value (the field itself for the immediate forms),
+        returns the old value for rd
+        """
+        old = self.read(addr)
+        op = name[4]
+        if op == 'w':
+            self.write(addr, src)
+        elif rs1:
+            # csrrs and csrrc with x0 / zimm 0 only read
+            self.write(addr, old | src if op == 's' else old & ~src)
+        return old
+
+    def save(self):
+        "the state to checkpoint, the cycle, time and instret values and the other csrs"
+        now = self.retired()
+        return [now + off for off in self.offsets], dict(self.csrs)
+
+    def load(self, counters, csrs, now):
+        "restore a saved state, the counters continue from their values at a retire count of now"
+        self.offsets = [val - now for val in counters]
+        self.csrs = dict(csrs)
+
+    def name(self, addr):
+        "the name of the csr at addr"
+        return csr_names.get(addr, f"csr{addr:03x}")
+
+    def display(self):
+        "print the csrs written so far"
+        for addr, val in sorted(self.csrs.items()):
+            print(f"{self.name(addr).rjust(10)}: {val:08x}")
+        print()
+
+# testbench for the csr file
+if __name__=="__main__":
+    count = [0]
+    csr = CSRFile(lambda: count[0])
+    count[0] = 100
+    print(f"mhartid = {csr.read(0xF14)}, misa = {csr.read(0x301):08x}")
+    print(f"cycle = {csr.read(0xC00)}, instret = {csr.read(0xC02)}")
+    csr.write(0xB00, 5)
+    count[0] = 110
+    print(f"mcycle after writing 5, 10 instructions ago = {csr.read(0xB00)}")
+    assert csr.execute('csrrs', 0x300, 5, 0x8) == 0
+    assert csr.execute('csrrc', 0x300, 5, 0x8) == 0x8
+    assert csr.execute('csrrwi', 0x340, 3, 3) == 0
+    assert csr.execute('csrrsi', 0x340, 0, 0) == 3
+    csr.write(0xC00, 0)  # read only
+    print(f"cycle = {csr.read(0xC00)}, mcycleh = {csr.read(0xB80)}")
+    csr.display()
@@ -0,0 +1,22 @@
+"""
+engine_util.py
+==============
+Helpers shared by the execution engines (functional.py, blocks.py and the
+jit on top of it) and the datapath alu.
+"""
+MASK = 0xffffffff
+
+# the csr instructions, they read the live retire count so the engines run
+# them from their slow paths
+CSRS = ('csrrw', 'csrrs', 'csrrc', 'csrrwi', 'csrrsi', 'csrrci')
+
+def signed(x):
+    "view an unsigned 32-bit value as signed"
+    return (x ^ 0x80000000) - 0x80000000
+
+def unsigned_regs(rf):
+    "make the registers of rf unsigned 32-bit values, undefined ones zero, returns rf.regs"
+    regs = rf.regs
+    for n, v in enumerate(regs):
+        regs[n] = 0 if v == None else v & MASK
+    return regs
@@ -0,0 +1,388 @@
+"""
+functional.py
+=============
+Functional (instruction set level) execution mode for the onestage simulator.
+
+Each mnemonic maps to a handler bound to the register array and memory when
+the engine is built. A handler takes the decoded instruction, applies its
+effect to the registers and memory directly and returns the next pc, there
+are no muxes or control signals. Decoded instructions are cached by pc,
+stores drop the words they overwrite and fence.i drops them all. The csr
+instructions (and the calls and returns followed by a CallGraphProfiler)
+need the live retire count: they are cached apart, where only the cache
+miss path that keeps instret current finds them.
+
+With a Stats collector (stats.py) each retired instruction is counted by
+its mnemonic id in a separate run loop, so the plain loop pays nothing.
+A TraceBuffer (tracer.py) gets a record per retired instruction the same way,
+a Trigger picks the instructions recorded.
+
+The architectural state and the syscall output match the datapath, only
+the simulated wires are gone. Registers are unsigned 32-bit values.
+"""
+from riscv_isa import BadInstruction
+from riscv_isa.decode_table import decode
+from htif import Halt
+from csrfile import CSRFile
+from profiler import call_kind
+from engine_util import MASK, CSRS, signed, unsigned_regs
+
+class FunctionalEngine:
+    "runs a program one instruction at a time through per mnemonic handlers"
+    def __init__(self, mem, rf, host, stats = None, calls = None, trace = None, trigger = None):
+        """
+        mem is the sodor style Memory wrapping the system ELFMemory,
+        rf the RegFile, host the HTIF servicing ecalls and syscalls,
+        stats an optional Stats collector counting the retired instructions,
+        calls an optional CallGraphProfiler told about calls and returns
+        and trace an optional TraceBuffer recording the retired instructions
+        the optional Trigger selects
+        """
+        self.mem = mem.mem
+        self.rf = rf
+        self.host = host
+        # registers are unsigned 32-bit ints, undefined ones read as zero
+        self.regs = unsigned_regs(rf)
+        self.cache = {}  # pc -> (handler, decoded instruction)
+        self.slow = {}   # the same for instructions that read the retire count
+        self.stats = stats
+        self.calls = calls
+        self.trace = trace
+        self.trigger = trigger
+        self.instret = 0
+        self.csrs = CSRFile(lambda: self.instret)
+        self.handlers = _handlers(self)
+
+    def fetch(self, pc):
+        "decode the instruction at pc and cache it with its handler, None at the end of the program"
+        entry = self.slow.get(pc)
+        if entry != None:
+            return entry
+        val = self.mem[pc]
+        if val == 0:
+            # the program ends at a zero word
+            return None
+        try:
+            instr = decode(val, pc)
+        except KeyError:
+            raise BadInstruction(f"Cannot decode {val:08x} at {pc:08x}")
+        try:
+            handler = self.handlers[instr.instr]
+        except KeyError:
+            raise BadInstruction(f"{instr.instr} at {pc:08x} is not supported")
+        kind = None if self.calls == None else call_kind(instr)
+        if kind != None:
+            self.slow[pc] = entry = (_followed(self, handler, kind), instr)
+        elif instr.instr in CSRS:
+            self.slow[pc] = entry = (handler, instr)
+        else:
+            self.cache[pc] = entry = (handler, instr)
+        return entry
+
+    def run(self, pc, limit = None):
+        """
+        run from pc until the program ends (returns None) or limit
+        instructions retired (returns the next pc), raises Halt when the guest exits
+        """
+        if self.stats != None:
+            return self.run_counted(pc, limit)
+        if self.trace != None:
+            return self.run_traced(pc, limit)
+        cache = self.cache
+        r = self.regs
+        n = self.instret
+        stop = float('inf') if limit == None else n + limit
+        try:
+            while n < stop:
+                entry = cache.get(pc)
+                if entry == None:
+                    self.instret = n
+                    entry = self.fetch(pc)
+                    if entry == None:
+                        return None
+                handler, instr = entry
+                pc = handler(instr)
+                # x0 is hardwired, undo any write to it
+                r[0] = 0
+                n += 1
+            return pc
+        except Halt as h:
+            # the instruction that halted retired
+            h.pc = pc
+            n += 1
+            raise
+        finally:
+            self.instret = n
+
+    def run_counted(self, pc, limit = None):
+        "run like run, counting each retired instruction in the stats"
+        cache = self.cache
+        r = self.regs
+        counts = self.stats.counts
+        taken = self.stats.taken
+        n = self.instret
+        stop = float('inf') if limit == None else n + limit
+        try:
+            while n < stop:
+                entry = cache.get(pc)
+                if entry == None:
+                    self.instret = n
+                    entry = self.fetch(pc)
+                    if entry == None:
+                        return None
+                handler, instr = entry
+                # counted first so an instruction that halts is included
+                counts[instr.id] += 1
+                pc = handler(instr)
+                if pc != instr.pc + 4:
+                    taken[instr.id] += 1
+                r[0] = 0
+                n += 1
+            return pc
+        except Halt as h:
+            h.pc = pc
+            n += 1
+            raise
+        finally:
+            self.instret = n
+
+    def run_traced(self, pc, limit = None):
+        "run like run, recording each retired instruction in the trace"
+        cache = self.cache
+        r = self.regs
+        record = self.trace.record
+        check = None if self.trigger == None else self.trigger.check
+        traced = False
+        n = self.instret
+        stop = float('inf') if limit == None else n + limit
+        try:
+            while n < stop:
+                entry = cache.get(pc)
+                if entry == None:
+                    self.instret = n
+                    entry = self.fetch(pc)
+                    if entry == None:
+                        return None
+                handler, instr = entry
+                # checked before the handler, a call at the start pc changes ra
+                traced = check == None or check(pc, r[1])
+                # the address before the handler, a load can overwrite rs1
+                ctrl = instr.ctrl
+                addr = (r[instr.rs1] + instr.imm) & MASK if ctrl != None and ctrl.mem_em else 0
+                pc = handler(instr)
+                r[0] = 0
+                if traced:
+                    record(instr.pc, instr.val, r[instr.rd] if instr.rd else 0, addr)
+                n += 1
+            return pc
+        except Halt as h:
+            # the halting ecall or tohost store writes no register
+            if traced:
+                record(instr.pc, instr.val, 0, addr)
+            h.pc = pc
+            n += 1
+            raise
+        finally:
+            self.instret = n
+
+    def stored(self, addr, size):
+        "drop the cached instructions a store of size bytes at addr overwrote"
+        for cache in (self.cache, self.slow):
+            if cache:
+                cache.pop(addr & ~0b11, None)
+                cache.pop((addr + size - 1) & ~0b11, None)
+
+    def __str__(self):
+        return f"Functional: {self.instret} instructions retired, {len(self.cache)} decoded"
+
+def _handlers(e):
+    "build the handlers of an engine, mnemonic -> f(instr) returning the next pc"
+    r = e.regs
+    load = e.mem.load
+    store = e.mem.store
+    stored = e.stored
+    host = e.host
+    execute = e.csrs.execute
+
+    # register-register and register-immediate alu ops
+    def add(i):
+        r[i.rd] = (r[i.rs1] + r[i.rs2]) & MASK
+        return i.pc + 4
+    def sub(i):
+        r[i.rd] = (r[i.rs1] - r[i.rs2]) & MASK
+        return i.pc + 4
+    def sll(i):
+        r[i.rd] = (r[i.rs1] << (r[i.rs2] & 0x1f)) & MASK
+        return i.pc + 4
+    def slt(i):
+        r[i.rd] = 1 if signed(r[i.rs1]) < signed(r[i.rs2]) else 0
+        return i.pc + 4
+    def sltu(i):
+        r[i.rd] = 1 if r[i.rs1] < r[i.rs2] else 0
+        return i.pc + 4
+    def xor(i):
+        r[i.rd] = r[i.rs1] ^ r[i.rs2]
+        return i.pc + 4
+    def srl(i):
+        r[i.rd] = r[i.rs1] >> (r[i.rs2] & 0x1f)
+        return i.pc + 4
+    def sra(i):
+        r[i.rd] = (signed(r[i.rs1]) >> (r[i.rs2] & 0x1f)) & MASK
+        return i.pc + 4
+    def or_(i):
+        r[i.rd] = r[i.rs1] | r[i.rs2]
+        return i.pc + 4
+    def and_(i):
+        r[i.rd] = r[i.rs1] & r[i.rs2]
+        return i.pc + 4
+    def addi(i):
+        r[i.rd] = (r[i.rs1] + i.imm) & MASK
+        return i.pc + 4
+    def slti(i):
+        r[i.rd] = 1 if signed(r[i.rs1]) < i.imm else 0
+        return i.pc + 4
+    def sltiu(i):
+        r[i.rd] = 1 if r[i.rs1] < i.imm & MASK else 0
+        return i.pc + 4
+    def xori(i):
+        r[i.rd] = r[i.rs1] ^ (i.imm & MASK)
+        return i.pc + 4
+    def ori(i):
+        r[i.rd] = r[i.rs1] | (i.imm & MASK)
+        return i.pc + 4
+    def andi(i):
+        r[i.rd] = r[i.rs1] & i.imm
+        return i.pc + 4
+    def slli(i):
+        r[i.rd] = (r[i.rs1] << (i.imm & 0x1f)) & MASK
+        return i.pc + 4
+    def srli(i):
+        r[i.rd] = r[i.rs1] >> (i.imm & 0x1f)
+        return i.pc + 4
+    def srai(i):
+        r[i.rd] = (signed(r[i.rs1]) >> (i.imm & 0x1f)) & MASK
+        return i.pc + 4
+    def lui(i):
+        r[i.rd] = i.imm & MASK
+        return i.pc + 4
+    def auipc(i):
+        r[i.rd] = (i.pc + i.imm) & MASK
+        return i.pc + 4
+
+    # loads and stores
+    def lb(i):
+        r[i.rd] = ((load((r[i.rs1] + i.imm) & MASK, 1) ^ 0x80) - 0x80) & MASK
+        return i.pc + 4
+    def lh(i):
+        r[i.rd] = ((load((r[i.rs1] + i.imm) & MASK, 2) ^ 0x8000) - 0x8000) & MASK
+        return i.pc + 4
+    def lw(i):
+        r[i.rd] = load((r[i.rs1] + i.imm) & MASK, 4)
+        return i.pc + 4
+    def lbu(i):
+        r[i.rd] = load((r[i.rs1] + i.imm) & MASK, 1)
+        return i.pc + 4
+    def lhu(i):
+        r[i.rd] = load((r[i.rs1] + i.imm) & MASK, 2)
+        return i.pc + 4
+    def storer(size):
+        trigger = host.trigger
+        def st(i):
+            addr = (r[i.rs1] + i.imm) & MASK
+            store(addr, r[i.rs2], size)
+            stored(addr, size)
+            if addr == trigger:
+                host.syscall()
+            return i.pc + 4
+        return st
+
+    # branches and jumps
+    def brancher(cond):
+        def br(i):
+            if cond(r[i.rs1], r[i.rs2]):
+                return (i.pc + i.imm) & MASK
+            return i.pc + 4
+        return br
+    def jal(i):
+        r[i.rd] = i.pc + 4
+        return (i.pc + i.imm) & MASK
+    def jalr(i):
+        target = (r[i.rs1] + i.imm) & 0xfffffffe
+        r[i.rd] = i.pc + 4
+        return target
+
+    # system
+    def ecall(i):
+        host.ecall(r[10], r[11], r[17])
+        return i.pc + 4
+    def fence_i(i):
+        e.cache.clear()
+        e.slow.clear()
+        return i.pc + 4
+    def csr(i):
+        r[i.rd] = execute(i.instr, i.val >> 20, i.rs1, r[i.rs1])
+        return i.pc + 4
+    def csr_imm(i):
+        r[i.rd] = execute(i.instr, i.val >> 20, i.rs1, i.rs1)
+        return i.pc + 4
+    def nop(i):
+        # fence, ebreak and mret have no effect here
+        return i.pc + 4
+
+    return {
+        'add': add, 'sub': sub, 'sll': sll, 'slt': slt, 'sltu': sltu,
+        'xor': xor, 'srl': srl, 'sra': sra, 'or': or_, 'and': and_,
+        'addi': addi, 'slti': slti, 'sltiu': sltiu, 'xori': xori,
+        'ori': ori, 'andi': andi, 'slli': slli, 'srli': srli, 'srai': srai,
+        'lui': lui, 'auipc': auipc,
+        'lb': lb, 'lh': lh, 'lw': lw, 'lbu': lbu, 'lhu': lhu,
+        'sb': storer(1), 'sh': storer(2), 'sw': storer(4),
+        'beq': brancher(lambda a, b: a == b),
+        'bne': brancher(lambda a, b: a != b),
+        'blt': brancher(lambda a, b: signed(a) < signed(b)),
+        'bge': brancher(lambda a, b: signed(a) >= signed(b)),
+        'bltu': brancher(lambda a, b: a < b),
+        'bgeu': brancher(lambda a, b: a >= b),
+        'jal': jal, 'jalr': jalr,
+        'ecall': ecall, 'fence.i': fence_i,
+        'fence': nop, 'ebreak': nop, 'mret': nop,
+        'csrrw': csr, 'csrrs': csr, 'csrrc': csr,
+        'csrrwi': csr_imm, 'csrrsi': csr_imm, 'csrrci': csr_imm,
+    }
+
+def _followed(e, handler, kind):
+    "wrap the handler of a call or return to tell the call graph profiler"
+    calls = e.calls
+    if kind == 'call':
+        def call(i):
+            pc = handler(i)
+            calls.call(pc, e.instret)
+            return pc
+        return call
+    def ret(i):
+        pc = handler(i)
+        calls.ret(e.instret)
+        return pc
+    return ret
+
+# testbench, run an elf and report the speed
+if __name__=="__main__":
+    import sys, time
+    from pydigital.memory import Memory
+    from pydigital.elfloader import load_elf
+    from regfile import ArrayRegFile
+    from htif import HTIF
+
+    if len(sys.argv) < 2:
+        exit("ERROR: input elf file not provided!")
+    mem, symbols = load_elf(sys.argv[1], quiet=True)
+    engine = FunctionalEngine(Memory(mem), ArrayRegFile(), HTIF(mem, symbols, sys.argv[1]))
+    start = time.perf_counter()
+    code = 0
+    try:
+        engine.run(symbols['_start'])
+    except Halt as h:
+        code = h.code
+    elapsed = time.perf_counter() - start
+    print(engine)
+    print(f"exit code {code}, {elapsed:.3f} s, {engine.instret / elapsed / 1e6:.3f} MIPS")
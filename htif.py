@@ -0,0 +1,102 @@
+"""
+htif.py
+=======
+Host interface shared by the simulators.
+
+Two conventions are supported:
+ * the exit syscall (ecall with a7 = 93, riscv-tests, newlib exit) stops the
+   program with exit code a0. Any other ecall with a0 = 1 prints a1,
+   a0 = 0 (halt) or 10 (exit) stops the program.
+ * UCB style tohost/fromhost syscalls (riscv-tests, benchmarks), a syscall
+   is made by storing to the upper word of tohost.
+"""
+from pydigital.utils import sextend
+
+class Halt(Exception):
+    "raised when the guest program stops, code is its exit code"
+    def __init__(self, code = 0):
+        super().__init__(code)
+        self.code = code
+
+class HTIF:
+    "services guest ecalls and tohost syscalls"
+    def __init__(self, mem, symbols, name, debug = False, quiet = False, out = None):
+        """
+        mem is the system (ELF) memory, symbols the elf symbol map and
+        name is used to prefix the program output when not debugging,
+        quiet drops all output (eg. for a shadow simulation) and out is
+        the file the output is printed to (stdout by default)
+        """
+        self.mem = mem
+        self.name = name
+        self.debug = debug and not quiet
+        self.quiet = quiet
+        self.out = out
+        self.tohost = symbols.get('tohost')
+        self.fromhost = symbols.get('fromhost')
+        # storing to the upper word of tohost makes the syscall
+        self.trigger = None if self.tohost == None else self.tohost + 4
+
+    def ecall(self, a0, a1, a7 = None):
+        "handle an ecall given the a0, a1 and a7 register values, raises Halt on exit"
+        if a7 == 93:
+            # the exit syscall, riscv-tests fail with a0 = test number << 1 | 1
+            if self.debug: print(f"ECALL({a0}): EXIT ({a0})\n", file=self.out)
+            raise Halt(a0)
+        # otherwise a0 selects the call
+        if a0 == 1:
+            # print the (signed) integer in a1
+            a1 = sextend(a1 & 0xffffffff)
+            if self.debug: print(f"ECALL({a0}): {a1}\n", file=self.out)
+            elif not self.quiet: print(f"{self.name} output -- {a1}", file=self.out)
+        elif a0 == 0 or a0 == 10:
+            if self.debug: print(f"ECALL({a0}): " + ('EXIT\n' if a0 == 10 else 'HALT\n'), file=self.out)
+            raise Halt(0)
+
+    def syscall(self):
+        "handle the syscall in tohost, call after a store to the trigger address"
+        mem = self.mem
+        val = mem[self.tohost]
+        # handle exit call
+        if val & 0b1 == 0b1:
+            if self.debug: print(f"SYSCALL: exit ({val>>1})\n", file=self.out)
+            raise Halt(val >> 1)
+        # handle printf if not exit
+        # tohost points to the syscall number followed by its args
+        which = mem[val]
+        arg1 = mem[val + 16]
+        arg2 = mem[val + 24]
+        # putchar implementation
+        if which == 64:
+            # print the chars
+            text = mem[arg1:arg1 + arg2].decode('ASCII')
+            if self.debug: print(f"SYSCALL: printf -- {text}", file=self.out)
+            elif not self.quiet: print(f"{self.name} output -- {text}", file=self.out)
+        mem[self.fromhost] = 1
+
+# testbench for the ecall conventions
+if __name__=="__main__":
+    import io
+    out = io.StringIO()
+    host = HTIF(None, {}, 'test', out = out)
+    # exit(1) has a0 = 1, the exit syscall wins over the print convention
+    try:
+        host.ecall(1, 0, 93)
+        assert False, "exit(1) did not halt"
+    except Halt as h:
+        assert h.code == 1
+    try:
+        host.ecall(0, 0, 93)
+        assert False, "exit(0) did not halt"
+    except Halt as h:
+        assert h.code == 0
+    # the legacy a0 conventions with any other a7
+    host.ecall(1, 0xffffffff, 0)
+    assert out.getvalue() == "test output -- -1\n"
+    for a0 in (0, 10):
+        try:
+            host.ecall(a0, 0, 0)
+            assert False, f"ecall {a0} did not halt"
+        except Halt as h:
+            assert h.code == 0
+    print("htif ok")
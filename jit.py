@@ -0,0 +1,513 @@
+"""
+jit.py
+======
+Hot region compiler, a second tier on top of the basic-block engine.
+
+Every block execution is counted. Once a block turns hot, the blocks
+reachable from it along the links taken so far (and not compiled yet) form
+a region, which is emitted as specialized python source and compile()d:
+ * registers live in local variables, loaded on entry and written back on exit
+ * immediates and pc relative values are folded into constants
+ * writes to x0 are removed
+ * loads and stores access the memory segment they hit while the region
+   was hot directly, other addresses take the ELFMemory path
+ * stores to pages no code was translated from skip the watched page
+   check, the region is dropped when code is translated from one of them
+A region can be entered at any of its blocks, each block is compiled once.
+Control stays inside the region's loop as long as the next pc is one of
+its blocks, the hottest are tested first.
+
+Pass dump (a file) to see the generated source. With check set every
+block or region is replayed on a shadow BlockEngine that steps one
+instruction at a time and the registers, pc and finally memory are
+compared, a mismatch raises Divergence.
+"""
+import copy, struct
+from functools import partial
+from pydigital.memory import Memory, MemoryFault
+from blocks import BlockEngine, Block, PAGE_BITS, MAX_BLOCK, MASK, TERMINATORS
+from htif import Halt
+
+# block executions before a region is compiled
+HOT = 50
+# most blocks in a region
+MAX_REGION = 32
+# blocks run fewer times when their region is built are left out of it
+WARM = 5
+
+SIGN = 0x80000000
+
+class Divergence(Exception):
+    "the compiled code and the reference disagree"
+    pass
+
+class JitEngine(BlockEngine):
+    "block engine that compiles hot regions to python source"
+    def __init__(self, mem, rf, host, hot = HOT, dump = None, check = False):
+        """
+        hot is the number of block executions before compiling,
+        dump a file to write the generated source to and check enables
+        the differential check against a shadow engine
+        """
+        super().__init__(mem, rf, host)
+        self.hot = hot
+        self.dump = dump
+        self.base = {}       # start pc -> first tier Block (regions replace them in blocks)
+        self.regions_of = {} # first tier Block -> the entries of the region compiled from it
+        self.unwatched = []  # (first page, last page, entries) its stores assume unwatched
+        self.retired = [0]   # instructions retired by the last region run, the engine clears it
+        self.compiled = 0
+        self.shadow = None
+        if check:
+            # the reference runs on its own copy of the machine state
+            shost = copy.copy(host)
+            shost.mem = copy.deepcopy(self.mem)
+            shost.quiet, shost.debug = True, False
+            self.shadow = BlockEngine(Memory(shost.mem), copy.deepcopy(rf),
+                shost, max_block = 1)
+
+    def run(self, pc, limit = None):
+        "same as BlockEngine.run, counting block executions to find hot regions"
+        slow = self.slow
+        blk = self.lookup(pc)
+        n = self.instret
+        stop = float('inf') if limit == None else n + limit
+        hot = self.hot
+        retired = self.retired
+        shadow = self.shadow
+        try:
+            while blk != None:
+                if not blk.count and stop - n < MAX_BLOCK:
+                    # a region may not fit, finish on the first tier blocks
+                    blk = self.base[blk.pc]
+                if n + blk.count > stop:
+                    # the limit falls inside the block
+                    pc = self.partial(blk, stop - n)
+                    if shadow != None:
+                        self.verify(blk, pc, stop - n)
+                    n = stop
+                    return pc
+                before = n
+                if blk.count:
+                    npc = blk.run()
+                    n += blk.count
+                    blk.hits += 1
+                    if blk.hits == hot:
+                        self.promote(blk)
+                else:
+                    # compiled region, it stops short of the budget
+                    npc = blk.run(stop - n)
+                    n += retired[0]
+                    retired[0] = 0
+                if shadow != None:
+                    self.verify(blk, npc, n - before)
+                nxt = blk.links.get(npc)
+                if nxt == None or not nxt.valid:
+                    self.instret = n
+                    nxt = self.lookup(npc)
+                    if nxt != None and npc not in slow:
+                        blk.links[npc] = nxt
+                blk = nxt
+            if shadow != None:
+                self.verify_memory()
+        except Halt as h:
+            if blk.count:
+                n += (h.pc - blk.pc) // 4 + 1
+            else:
+                n += retired[0]
+                retired[0] = 0
+            if shadow != None:
+                self.verify_halt(blk, h, n - before)
+            raise
+        finally:
+            self.instret = n
+
+    def translate(self, pc):
+        "translate a first tier block and remember it for region building"
+        page = pc >> PAGE_BITS
+        fresh = page not in self.watched
+        blk = super().translate(pc)
+        if blk != None and pc not in self.slow:
+            # csr blocks are never chained so they never join a region
+            self.base[pc] = blk
+        if fresh and page in self.watched:
+            # stores to the page need the slow path now
+            for first, last, entries in self.unwatched:
+                if first <= page <= last:
+                    self.drop_region(entries)
+            self.unwatched = [u for u in self.unwatched if u[2][0].valid]
+        return blk
+
+    def drop(self, blk):
+        "drop a block and the region compiled from it"
+        super().drop(blk)
+        self.drop_region(self.regions_of.pop(blk, ()))
+
+    def drop_region(self, entries):
+        "remove the entries of a region, its blocks are translated again when they run"
+        for entry in entries:
+            if entry.valid:
+                entry.valid = False
+                if self.blocks.get(entry.pc) is entry:
+                    del self.blocks[entry.pc]
+
+    def put(self, addr, val, size, pc, done):
+        """
+        a region store off its unwatched pages, done is the number of
+        instructions of its block retired with it, returns whether it dropped
+        translated code (the region returns then)
+        """
+        self.mem.store(addr, val, size)
+        if addr >> PAGE_BITS not in self.watched:
+            return False
+        try:
+            dropped = self.store_hook(addr, size, pc)
+        except Halt:
+            self.retired[0] += done
+            raise
+        if dropped:
+            self.retired[0] += done
+        return dropped
+
+    # --- region building ---
+    def promote(self, head):
+        "compile the hot region starting at head and install it in place of its blocks"
+        if not head.valid or self.blocks.get(head.pc) is not head:
+            return
+        # walk the links taken so far, hottest first, blocks in a region are invalid
+        parts = [head]
+        seen = {head.pc}
+        i = 0
+        while i < len(parts) and len(parts) < MAX_REGION:
+            for npc in sorted(parts[i].links, key=lambda pc: -self.base_hits(pc)):
+                b = self.base.get(npc)
+                if b != None and b.valid and npc not in seen and b.hits >= WARM \
+                        and self.blocks.get(npc) is b:
+                    seen.add(npc)
+                    parts.append(b)
+                    if len(parts) == MAX_REGION:
+                        break
+            i += 1
+
+        src, segments, pages = self.source(parts)
+        if self.dump != None:
+            print(src, file=self.dump)
+        env = {'r': self.regs, 'load': self.mem.load, 'put': self.put,
+               'ecall': self.host.ecall, 'flush': self.flush, 'retired': self.retired}
+        for k, seg in enumerate(segments):
+            env[f'v{k}'] = seg.view
+            order = '<' if seg.byteorder == 'little' else '>'
+            for size, code in ((1, 'B'), (2, 'H'), (4, 'I')):
+                st = struct.Struct(order + code)
+                env[f'ld{k}_{size}'] = st.unpack_from
+                env[f'st{k}_{size}'] = st.pack_into
+        exec(compile(src, f"<region {head.pc:08x}>", 'exec'), env)
+        # an entry per block, chained links to the first tier blocks now find them
+        entries = []
+        for b in parts:
+            entry = Block(b.pc, 0, partial(env['region'], b.pc))
+            entries.append(entry)
+            self.regions_of[b] = entries
+            b.valid = False
+            self.blocks[b.pc] = entry
+        if pages != None:
+            self.unwatched.append((*pages, entries))
+        self.compiled += 1
+
+    def base_hits(self, pc):
+        b = self.base.get(pc)
+        return 0 if b == None else b.hits
+
+    def source(self, parts):
+        """
+        generate the python source of a region made of the first tier blocks
+        parts, returns it, the memory segments its loads and stores access
+        and the (first, last) pages its stores assume unwatched (None if none)
+        """
+        used = set()
+        written = set()
+        for b in parts:
+            for i in b.instrs:
+                for reg in (i.rs1, i.rs2, i.rd):
+                    if reg:
+                        used.add(reg)
+                if i.rd and i.type not in ('s', 'sb'):
+                    written.add(i.rd)
+                if i.instr == 'ecall':
+                    used.update((10, 11, 17))
+        used = sorted(used)
+        written = sorted(written)
+
+        segments = []
+        pages = []
+        # pages code is or can be translated from, stores to them take the slow path
+        code = self.mem.segment(parts[0].pc)
+        watched = self.watched | set(range(code.begin_addr >> PAGE_BITS,
+                                           ((code.end_addr - 1) >> PAGE_BITS) + 1))
+        def segment(i, store = False):
+            """
+            the index, begin address and the [lo, hi) range to access directly
+            of the segment i accesses with the current registers (the stack
+            segment if that isn't mapped), None without one, for a store the
+            range only covers unwatched pages
+            """
+            addr = (self.regs[i.rs1] + i.imm) & MASK
+            try:
+                seg = self.mem.segment(addr)
+            except MemoryFault:
+                try:
+                    addr = self.regs[2]
+                    seg = self.mem.segment(addr)
+                except MemoryFault:
+                    return None
+            if seg not in segments:
+                segments.append(seg)
+            lo, hi = seg.begin_addr, seg.end_addr
+            if store:
+                first = last = addr >> PAGE_BITS
+                if first in watched:
+                    return None
+                while first - 1 >= lo >> PAGE_BITS and first - 1 not in watched:
+                    first -= 1
+                while last + 1 <= (hi - 1) >> PAGE_BITS and last + 1 not in watched:
+                    last += 1
+                lo, hi = max(lo, first << PAGE_BITS), min(hi, (last + 1) << PAGE_BITS)
+                pages.append((first, last))
+            return segments.index(seg), seg.begin_addr, lo, hi
+
+        # the region only starts a block that fits in the budget, the
+        # engine runs regions with at least MAX_BLOCK instructions left
+        most = max(b.count for b in parts)
+        lines = ["# region " + " ".join(f"{b.pc:08x}" for b in parts),
+            "def region(pc, budget, r=r, load=load, put=put, ecall=ecall, flush=flush, "
+            "retired=retired):"]
+        lines += [f"    x{reg} = r[{reg}]" for reg in used]
+        lines += ["    n = 0", f"    limit = budget - {most}", "    try:",
+            "        while n <= limit:"]
+        for k, b in enumerate(sorted(parts, key=lambda b: -b.hits)):
+            lines.append(f"            {'if' if k == 0 else 'elif'} pc == {_h(b.pc)}:")
+            body = []
+            for idx, instr in enumerate(b.instrs):
+                body += _emit(instr, idx, b.count, segment)
+            if b.instrs[-1].instr not in TERMINATORS:
+                # the block was cut without a terminator, fall through
+                body += [f"n += {b.count}", f"pc = {_h(b.pc + 4*b.count)}"]
+            lines += ["                " + l for l in body]
+        lines += ["            else:", "                return pc", "        return pc",
+            "    finally:"]
+        lines += [f"        r[{reg}] = x{reg}" for reg in written]
+        lines += ["        retired[0] += n"]
+        if pages:
+            pages = min(p[0] for p in pages), max(p[1] for p in pages)
+        return "\n".join(lines) + "\n", segments, pages or None
+
+    # --- differential check ---
+    def verify(self, blk, npc, count):
+        "replay count instructions on the shadow engine and compare"
+        shadow = self.shadow
+        spc = shadow.run(blk.pc, count)
+        if spc != npc or shadow.regs != self.regs:
+            raise Divergence(self.describe(blk, npc, spc))
+
+    def verify_halt(self, blk, h, count):
+        "the shadow must halt the same way"
+        try:
+            self.shadow.run(blk.pc, count)
+        except Halt as sh:
+            if sh.code == h.code and self.shadow.regs == self.regs:
+                return
+        raise Divergence(self.describe(blk, None, None) + f" on halt ({h.code})")
+
+    def verify_memory(self):
+        "compare all memory segments at the end of the program"
+        for seg, sseg in zip(self.mem.mems, self.shadow.mem.mems):
+            if seg.data != sseg.data:
+                raise Divergence(f"memory differs in {seg}")
+
+    def describe(self, blk, npc, spc):
+        regs = [f"x{i}: {a:08x} != {b:08x}" for i, (a, b)
+            in enumerate(zip(self.regs, self.shadow.regs)) if a != b]
+        kind = 'block' if blk.count else 'region'
+        npc = 'end' if npc == None else f"{npc:08x}"
+        spc = 'end' if spc == None else f"{spc:08x}"
+        return f"{kind} at {blk.pc:08x} went to {npc}, reference to {spc}; " + ", ".join(regs)
+
+    def __str__(self):
+        return super().__str__() + f", {self.compiled} regions compiled"
+
+# --- source emitters ---
+
+def _h(addr):
+    "source of an address constant"
+    return f"0x{addr & MASK:08x}"
+
+def _x(reg):
+    "source of a register read, x0 is the constant 0"
+    return f"x{reg}" if reg else "0"
+
+def _plus(reg, imm):
+    "source of a register plus an immediate wrapped to 32 bits"
+    if not reg:
+        return _h(imm)
+    if imm == 0:
+        return f"x{reg}"
+    if imm < 0:
+        return f"(x{reg} - {-imm}) & 0xffffffff"
+    return f"(x{reg} + {imm}) & 0xffffffff"
+
+def _sum(reg, imm):
+    "source of a register plus an immediate, not wrapped"
+    if not reg:
+        return f"{imm}"
+    if imm == 0:
+        return f"x{reg}"
+    return f"x{reg} - {-imm}" if imm < 0 else f"x{reg} + {imm}"
+
+def _fast(reg, imm, size, begin, lo, hi):
+    """
+    sources of the test that reg plus imm is a direct access of size in
+    [lo, hi) and of its offset from begin, the immediate is folded in both
+    """
+    return f"{lo - imm} <= {_x(reg)} <= {hi - size - imm}", _sum(reg, imm - begin)
+
+def _sx(reg):
+    "source of a register read biased so unsigned compares act signed"
+    return f"(x{reg} ^ {SIGN})" if reg else f"{SIGN}"
+
+_alu_rr = {
+    'add': "({a} + {b}) & 0xffffffff",
+    'sub': "({a} - {b}) & 0xffffffff",
+    'sll': "({a} << ({b} & 31)) & 0xffffffff",
+    'slt': "1 if {sa} < {sb} else 0",
+    'sltu': "1 if {a} < {b} else 0",
+    'xor': "{a} ^ {b}",
+    'srl': "{a} >> ({b} & 31)",
+    'sra': "(({sa} - %d) >> ({b} & 31)) & 0xffffffff" % SIGN,
+    'or': "{a} | {b}",
+    'and': "{a} & {b}",
+}
+
+_branch = {
+    'beq': "{a} == {b}",
+    'bne': "{a} != {b}",
+    'blt': "{sa} < {sb}",
+    'bge': "{sa} >= {sb}",
+    'bltu': "{a} < {b}",
+    'bgeu': "{a} >= {b}",
+}
+
+_loads = {'lb': (1, True), 'lh': (2, True), 'lw': (4, False),
+          'lbu': (1, False), 'lhu': (2, False)}
+_stores = {'sb': 1, 'sh': 2, 'sw': 4}
+
+def _imm_expr(name, rs1, imm):
+    "source of an alu op with an immediate, folded where possible"
+    a = _x(rs1)
+    u = imm & MASK
+    if name == 'addi':
+        return _plus(rs1, imm)
+    if name == 'slti':
+        return f"{1 if 0 < imm else 0}" if not rs1 else f"1 if {_sx(rs1)} < {u ^ SIGN} else 0"
+    if name == 'sltiu':
+        return f"{1 if 0 < u else 0}" if not rs1 else f"1 if {a} < {u} else 0"
+    if name == 'andi':
+        return "0" if not rs1 else f"{a} & {u}"
+    if name == 'ori':
+        return f"{u}" if not rs1 else f"{a} | {u}"
+    if name == 'xori':
+        return f"{u}" if not rs1 else f"{a} ^ {u}"
+    sh = imm & 0x1f
+    if name == 'slli':
+        return "0" if not rs1 else f"({a} << {sh}) & 0xffffffff"
+    if name == 'srli':
+        return "0" if not rs1 else f"{a} >> {sh}"
+    if name == 'srai':
+        return "0" if not rs1 else f"(({_sx(rs1)} - {SIGN}) >> {sh}) & 0xffffffff"
+    return None
+
+def _emit(i, idx, count, segment):
+    """
+    python source lines for instruction i, the idx-th of a block of count,
+    segment finds the segment a load or store likely accesses
+    """
+    name = i.instr
+    pc = i.pc
+    if name in _branch:
+        cond = _branch[name].format(a=_x(i.rs1), b=_x(i.rs2), sa=_sx(i.rs1), sb=_sx(i.rs2))
+        return [f"n += {count}",
+            f"pc = {_h(pc + i.imm)} if {cond} else {_h(pc + 4)}"]
+    if name == 'jal':
+        lines = [f"n += {count}"]
+        if i.rd:
+            lines.append(f"x{i.rd} = {_h(pc + 4)}")
+        return lines + [f"pc = {_h(pc + i.imm)}"]
+    if name == 'jalr':
+        lines = [f"n += {count}", f"pc = {_plus(i.rs1, i.imm)} & 0xfffffffe"]
+        if i.rd:
+            lines.append(f"x{i.rd} = {_h(pc + 4)}")
+        return lines
+    if name == 'ecall':
+        return [f"n += {count}", "ecall(x10, x11, x17)", f"pc = {_h(pc + 4)}"]
+    if name == 'fence.i':
+        return [f"n += {count}", "flush()", f"return {_h(pc + 4)}"]
+    if name in _stores:
+        size = _stores[name]
+        # the region ends if the slow path dropped code
+        slow = f"put({{}}, {_x(i.rs2)}, {size}, {_h(pc)}, {idx + 1}): return {_h(pc + 4)}"
+        seg = segment(i, store = True)
+        if seg == None:
+            return ["if " + slow.format(_plus(i.rs1, i.imm))]
+        k, begin, lo, hi = seg
+        test, offset = _fast(i.rs1, i.imm, size, begin, lo, hi)
+        val = _x(i.rs2) if size == 4 or not i.rs2 else f"x{i.rs2} & {(1 << 8*size) - 1}"
+        return [f"if {test}: st{k}_{size}(v{k}, {offset}, {val})",
+            "elif " + slow.format(_plus(i.rs1, i.imm))]
+    if not i.rd:
+        # x0 writes and no-ops
+        return []
+    rd = f"x{i.rd}"
+    if name in _alu_rr:
+        expr = _alu_rr[name].format(a=_x(i.rs1), b=_x(i.rs2), sa=_sx(i.rs1), sb=_sx(i.rs2))
+    elif name == 'lui':
+        expr = f"{i.imm & MASK}"
+    elif name == 'auipc':
+        expr = f"{_h(pc + i.imm)}"
+    elif name in _loads:
+        size, signed = _loads[name]
+        seg = segment(i)
+        expr = f"load({_plus(i.rs1, i.imm)}, {size})"
+        if seg != None:
+            k, begin, lo, hi = seg
+            test, offset = _fast(i.rs1, i.imm, size, begin, lo, hi)
+            expr = f"ld{k}_{size}(v{k}, {offset})[0] if {test} else {expr}"
+        if signed and size < 4:
+            sign = 1 << (8*size - 1)
+            expr = f"((({expr}) ^ {sign}) - {sign}) & 0xffffffff"
+    else:
+        expr = _imm_expr(name, i.rs1, i.imm)
+        if expr == None:
+            # fence, mret, ... have no effect here
+            return []
+    return [f"{rd} = {expr}"]
+
+# testbench, run an elf with the differential check on and report the speed
+if __name__=="__main__":
+    import sys, time
+    from pydigital.elfloader import load_elf
+    from regfile import ArrayRegFile
+    from htif import HTIF
+
+    if len(sys.argv) < 2:
+        exit("ERROR: input elf file not provided!")
+    mem, symbols = load_elf(sys.argv[1], quiet=True)
+    engine = JitEngine(Memory(mem), ArrayRegFile(), HTIF(mem, symbols, sys.argv[1]),
+        dump = sys.stdout if '-dump' in sys.argv else None, check = True)
+    start = time.perf_counter()
+    code = 0
+    try:
+        engine.run(symbols['_start'])
+    except Halt as h:
+        code = h.code
+    elapsed = time.perf_counter() - start
+    print(engine)
+    print(f"exit code {code}, {elapsed:.3f} s, {engine.instret / elapsed / 1e6:.3f} MIPS (checked)")
@@ -0,0 +1,127 @@
+"""
+microbench.py
+=============
+Host side microbenchmarks for the simulator hot paths.
+
+Each primitive (memory access, decode, alu, register file, control
+formatting and the utils) is timed in isolation with timeit: a warmup
+round, then the best of several repeats is reported in ns/op. The results
+can be saved as a JSON baseline (-save=file) and compared against later
+(-baseline=file), so a change to one primitive shows its per-op delta
+without running a whole benchmark program.
+
+usage: python microbench.py [name filters] [-n=repeats] [-save=file.json]
+                            [-baseline=file.json] [-threshold=percent]
+"""
+import sys, json, timeit
+from pydigital.memory import MemorySegment, ELFMemory
+from pydigital.utils import sextend, as_twos_comp, verilog_fmt
+from riscv_isa.isa import Instruction
+from riscv_isa.control import controlFormatter
+from regfile import RegFile
+from alu import alu
+
+# defaults for the timing runs
+REPEATS = 5
+THRESHOLD = 10.0
+
+def setup():
+    "build the objects the benchmarks run on, returns the timeit globals"
+    seg = MemorySegment(0x1000, count = 1024, byteorder = 'little')
+    elfmem = ELFMemory()
+    for base in (0x1000, 0x80000000, 0x80010000):
+        elfmem += MemorySegment(base, count = 1024, byteorder = 'little')
+    rf = RegFile()
+    for i in range(1, 32):
+        rf.clock(i, i, 1)
+    return {
+        'seg': seg, 'elfmem': elfmem, 'rf': rf,
+        # addi a0,a0,1 and a branch, the branch also formats its target
+        'Instruction': Instruction, 'addi': Instruction(0x00150513, 0x80000000),
+        'beq': Instruction(0x4a770a63, 0x800001a0),
+        'alu': alu, 'controlFormatter': controlFormatter,
+        'sextend': sextend, 'as_twos_comp': as_twos_comp, 'verilog_fmt': verilog_fmt,
+    }
+
+# name -> statement timed, the statements run with the setup() globals
+benchmarks = {
+    'MemorySegment.__getitem__': "seg[0x1100]",
+    'MemorySegment.__setitem__': "seg[0x1100] = 0x12345678",
+    'ELFMemory.__getitem__ (hit)': "elfmem[0x80000100]",
+    'ELFMemory.__getitem__ (switch)': "elfmem[0x80000100]; elfmem[0x80010100]",
+    'ELFMemory.__setitem__': "elfmem[0x80000100] = 0x12345678",
+    'Instruction (i type)': "Instruction(0x00150513, 0x80000000)",
+    'Instruction (b type)': "Instruction(0x4a770a63, 0x800001a0)",
+    'Instruction.__str__ (i type)': "str(addi)",
+    'Instruction.__str__ (b type)': "str(beq)",
+    'alu (add)': "alu(0x7fffffff, 1, 5)",
+    'alu (sra)': "alu(0x80000000, 4, 7)",
+    'RegFile.read': "rf.read(10)",
+    'RegFile.clock': "rf.clock(10, 0x1234, 1)",
+    'controlFormatter': "controlFormatter('add', 'ALU_fun')",
+    'sextend': "sextend(0xfff, 12)",
+    'as_twos_comp': "as_twos_comp(-1)",
+    'verilog_fmt': "verilog_fmt('%3t: pc = %08x, val = %d', 0x80000000, 42, timeval = 7)",
+}
+
+def measure(stmt, glob, repeats = REPEATS):
+    "time stmt, returns the best ns/op of repeats runs after a warmup"
+    timer = timeit.Timer(stmt, globals = glob)
+    # the warmup also picks a loop count that runs for about 0.2 s
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeats, number))
+    return 1e9 * best / number
+
+def run(names = None, repeats = REPEATS):
+    "run the benchmarks (all if names is None), returns name -> ns/op"
+    glob = setup()
+    return {name: measure(stmt, glob, repeats) for name, stmt in benchmarks.items()
+            if names == None or name in names}
+
+if __name__=="__main__":
+    filters = []
+    repeats = REPEATS
+    threshold = THRESHOLD
+    save = baseline = None
+    for arg in sys.argv[1:]:
+        if arg.startswith('-n='):
+            repeats = max(1, int(arg.split('=', 1)[1]))
+        elif arg.startswith('-threshold='):
+            threshold = float(arg.split('=', 1)[1])
+        elif arg.startswith('-save='):
+            save = arg.split('=', 1)[1]
+        elif arg.startswith('-baseline='):
+            baseline = arg.split('=', 1)[1]
+        elif arg.startswith('-'):
+            exit(f"ERROR: unknown option {arg}")
+        else:
+            filters.append(arg)
+    # a benchmark runs if its name contains any of the filters
+    names = [n for n in benchmarks if not filters or any(f in n for f in filters)]
+
+    old = {}
+    if baseline:
+        with open(baseline) as f:
+            old = json.load(f)['results']
+    results = run(names, repeats)
+
+    slower = []
+    print(f"{'benchmark':32s} {'ns/op':>9s} {'baseline':>9s} {'change':>8s}")
+    for name, ns in results.items():
+        if name in old:
+            change = 100.0 * (ns - old[name]) / old[name]
+            flag = ''
+            if change > threshold:
+                slower.append(name)
+                flag = '  SLOWER'
+            print(f"{name:32s} {ns:9.1f} {old[name]:9.1f} {change:+7.1f}%{flag}")
+        else:
+            print(f"{name:32s} {ns:9.1f} {'-':>9s} {'-':>8s}")
+
+    if save:
+        with open(save, 'w') as f:
+            json.dump({'repeats': repeats, 'python': sys.version.split()[0],
+                       'results': results}, f, indent = 2)
+    if slower:
+        print(f"{len(slower)} benchmark(s) slower by more than {threshold}%: {', '.join(slower)}")
+        exit(1)
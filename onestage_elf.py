@@ -4,22 +4,72 @@ import itertools
 from pydigital.memory import readmemh, Memory, MemorySegment
 from pydigital.register import Register
 from pydigital.elfloader import load_elf
-from pydigital.utils import as_twos_comp
-from riscv_isa.control import controlFormatter
-from riscv_isa import Instruction
-from regfile import RegFile
+from pydigital.utils import as_twos_comp, sextend
+from riscv_isa.decoder import renum
+from riscv_isa import DecodeCache
+from regfile import RegFile, ArrayRegFile
+from htif import HTIF, Halt
+from blocks import BlockEngine
+from jit import JitEngine
+from functional import FunctionalEngine
 from alu import alu
 from mux import make_mux
+from stats import Stats
+from csrfile import CSRFile
+from profiler import SamplingProfiler, CallGraphProfiler, INTERVAL
+from tracer import TraceBuffer, Trigger, resolve, parse_window
+import checkpoint
 
 # debug/silent flag
 DEBUG = True
 # test flag
 TEST = False
+# run the basic-block translation engine instead of the datapath
+BLOCKS = False
+# compile hot regions of the translated blocks to python source
+JIT = False
+# print the generated source / check it against the block engine
+DUMP = False
+CHECK = False
+# datapath with preallocated index based muxes instead of per cycle closures
+FAST = False
+# functional mode, run each instruction through its handler (no datapath)
+FUNC = False
+# retired instruction stats, printed at exit and optionally saved as json
+STATS = None
+STATS_JSON = None
+# sample the pc every PROF_INTERVAL instructions, printed at exit and
+# optionally saved as collapsed stacks
+PROF_INTERVAL = None
+COLLAPSED = None
+# follow calls and returns for a call graph, printed at exit and optionally
+# saved as collapsed stacks
+CALL_GRAPH = False
+CALLS_COLLAPSED = None
+# binary trace of the retired instructions, read with python tracer.py
+TRACE_FILE = None
+# trace triggers: the symbol (or address) starting the trace until it returns,
+# the most instructions traced and the lo:hi address range (or function) traced
+TRACE_START = None
+TRACE_COUNT = None
+TRACE_WINDOW = None
+# save the machine state after CKPT_AT retired instructions to CKPT_FILE,
+# start from the state saved in RESTORE_FILE
+CKPT_AT = None
+CKPT_FILE = None
+RESTORE_FILE = None
 
 # the PC register
 PC = Register()
 # the reg file
 RF = RegFile()
+# the csrs, one instruction retires per cycle and cycle 0 is the reset
+CSR = CSRFile(lambda: t - 1)
+# mux inputs for the fast datapath, set each cycle and indexed by the select
+OP1_IN = [None] * 3
+OP2_IN = [None] * 4
+WB_IN = [None] * 4
+PC_IN = [None] * 5
 
 # check if a path was provided
 if len(sys.argv) < 2:
@@ -33,6 +83,51 @@ for arg in sys.argv:
             DEBUG = False
         elif arg == '-t':
             TEST = True
+        elif arg == '-b': # block translation flag
+            BLOCKS = True
+        elif arg == '-j': # hot region compiler flag (implies -b)
+            BLOCKS = JIT = True
+        elif arg == '-dump':
+            DUMP = True
+        elif arg == '-check':
+            CHECK = True
+        elif arg == '-f': # fast datapath flag
+            FAST = True
+        elif arg == '-func': # functional mode flag
+            FUNC = True
+        elif arg.startswith('-stats'): # instruction stats, -stats=file.json saves them
+            STATS = Stats()
+            if arg.startswith('-stats='):
+                STATS_JSON = arg.split('=', 1)[1]
+        elif arg.startswith('-prof'): # sampling profiler, -prof=N samples every N instructions
+            PROF_INTERVAL = int(arg.split('=', 1)[1]) if arg.startswith('-prof=') else INTERVAL
+        elif arg.startswith('-calls'): # call graph profiler, -calls=file saves collapsed stacks
+            CALL_GRAPH = True
+            if arg.startswith('-calls='):
+                CALLS_COLLAPSED = arg.split('=', 1)[1]
+        elif arg.startswith('-collapsed='): # save the profile as collapsed stacks
+            COLLAPSED = arg.split('=', 1)[1]
+            PROF_INTERVAL = PROF_INTERVAL or INTERVAL
+        elif arg.startswith('-trace='): # binary trace, gzip compressed if the file ends in .gz
+            TRACE_FILE = arg.split('=', 1)[1]
+        elif arg.startswith('-trace-start='): # trace from a symbol until it returns
+            TRACE_START = arg.split('=', 1)[1]
+        elif arg.startswith('-trace-count='): # trace at most N instructions
+            TRACE_COUNT = int(arg.split('=', 1)[1])
+        elif arg.startswith('-trace-window='): # only trace inside lo:hi or a function
+            TRACE_WINDOW = arg.split('=', 1)[1]
+        elif arg.startswith('-checkpoint='): # -checkpoint=N:file saves the state after N instructions
+            at, CKPT_FILE = arg.split('=', 1)[1].split(':', 1)
+            CKPT_AT = int(at)
+        elif arg.startswith('-restore='): # start from a checkpoint of this elf
+            RESTORE_FILE = arg.split('=', 1)[1]
+
+if (STATS or CALL_GRAPH) and BLOCKS:
+    exit("ERROR: -stats and -calls need the datapath or the functional mode (-func)")
+if TRACE_FILE and JIT:
+    exit("ERROR: -trace needs the datapath, the block engine (-b) or the functional mode (-func)")
+if STATS and TRACE_FILE and FUNC:
+    exit("ERROR: -stats and -trace can't be combined in the functional mode")
 
 # get the inputted elf path
 elf_path = sys.argv[1]
@@ -44,8 +139,36 @@ try:
 except:
     exit("ERROR: couldn't read elf file!")
 
+# the checkpoint to continue from, restored once the machine is built
+RESTORED = None
+if RESTORE_FILE:
+    if CHECK:
+        exit("ERROR: -check builds its shadow before -restore, they can't be combined")
+    try:
+        RESTORED = checkpoint.load(RESTORE_FILE)
+    except (OSError, ValueError) as e:
+        exit(f"ERROR: couldn't restore {RESTORE_FILE}: {e}")
+
 # initialize memory from the elf
 MEM = Memory(imem)
+# decoded instructions are cached by pc with their typed load and store, loops only decode once
+ICACHE = DecodeCache(imem, MEM)
+# ecalls and tohost syscalls
+HOST = HTIF(imem, symbols, elf_path, DEBUG)
+# the pc sampling profiler
+PROF = None if PROF_INTERVAL == None else SamplingProfiler(elf_path, PROF_INTERVAL)
+# the call graph profiler
+CALLS = CallGraphProfiler(elf_path, symbols["_start"]) if CALL_GRAPH else None
+# the binary trace
+TRACE = None if TRACE_FILE == None else TraceBuffer(TRACE_FILE, elf_path)
+# what is traced, the text trace of the datapath follows it too
+TRIGGER = None
+if TRACE_START or TRACE_COUNT != None or TRACE_WINDOW:
+    try:
+        TRIGGER = Trigger(None if TRACE_START == None else resolve(TRACE_START, symbols),
+            TRACE_COUNT, None if TRACE_WINDOW == None else parse_window(TRACE_WINDOW, symbols, elf_path))
+    except ValueError as e:
+        exit(f"ERROR: {e}")
 
 def handle_test():
     "handles the output for test - checks whether test passed or not"
@@ -57,31 +180,55 @@ def handle_test():
         else:
             print(f"{sys.argv[1]} -- Test Failed! ({a0_val})")
 
+def handle_exit(code = 0):
+    "handles the end of the program, shows the final state and exits with code"
+    if DEBUG:
+        # print register values at the end of program
+        RF.display()
+        print(ENGINE if BLOCKS or FUNC else ICACHE)
+    handle_test()
+    if STATS:
+        print(STATS)
+        if STATS_JSON: STATS.dump_json(STATS_JSON)
+    if CALLS:
+        # the engines count for themselves, the datapath retires one instruction a cycle
+        CALLS.finish(ENGINE.instret if BLOCKS or FUNC else t)
+        print(CALLS)
+        if CALLS_COLLAPSED:
+            with open(CALLS_COLLAPSED, 'w') as f:
+                f.write(CALLS.collapsed())
+    if PROF:
+        print(PROF)
+        if COLLAPSED:
+            with open(COLLAPSED, 'w') as f:
+                f.write(PROF.collapsed())
+    if TRACE:
+        TRACE.close()
+    sys.exit(code)
+
+def save_checkpoint(pc, instret):
+    "save the machine state, pc is the next instruction and instret the instructions retired"
+    csrs = ENGINE.csrs if BLOCKS or FUNC else CSR
+    checkpoint.save(CKPT_FILE, checkpoint.snapshot(elf_path, pc, instret, RF.regs, csrs, imem))
+    if DEBUG: print(f"Checkpoint saved to {CKPT_FILE} at {instret} instructions\n")
+
+def restore(csrs, now):
+    "restore the checkpoint into the memory, RF and csrs, the counters continue from now, returns its pc"
+    try:
+        pc = checkpoint.restore(RESTORED, imem, RF, csrs, now)
+    except ValueError as e:
+        exit(f"ERROR: couldn't restore {RESTORE_FILE}: {e}")
+    if DEBUG: print(f"Restored {RESTORE_FILE} at {RESTORED.instret} instructions\n")
+    return pc
+
 def handle_syscall(mem_em, mem_wr, alu_val):
     "handles UCB syscalls"
     # check if a syscall was made
-    if mem_em == 1 and mem_wr == 1 and 'tohost' in symbols:
-        if alu_val == symbols['tohost'] + 4:
-            val = MEM.mem[symbols['tohost']]
-            # handle exit call
-            if val & 0b1 == 0b1:
-                if DEBUG: 
-                    print(f"SYSCALL: exit ({val>>1})\n")
-                    RF.display()
-                handle_test()
-                sys.exit(val>>1)
-            # handle printf if not exit
-            # get all the args for putchar
-            which = MEM.mem[MEM.mem[symbols['tohost']]]
-            arg0 = MEM.mem[MEM.mem[symbols['tohost']] + 8]
-            arg1 = MEM.mem[MEM.mem[symbols['tohost']] + 16]
-            arg2 = MEM.mem[MEM.mem[symbols['tohost']] + 24]
-            # putchar implementation
-            if which == 64:
-                # print the chars
-                if DEBUG: print(f"SYSCALL: printf -- {MEM.mem[arg1:arg1 + arg2].decode('ASCII')}")
-                else: print(f"{elf_path} output -- {MEM.mem[arg1:arg1 + arg2].decode('ASCII')}")
-            MEM.mem[symbols['fromhost']] = 1
+    if mem_em == 1 and mem_wr == 1 and alu_val == HOST.trigger:
+        try:
+            HOST.syscall()
+        except Halt as h:
+            handle_exit(h.code)
 
 def display():
     if pc_val == None:
@@ -105,7 +252,7 @@ def display():
         return f"PC: {pc_val:08x}, IR: {instr.val:08x}, {instr}" + \
             rd_str + rs1_str + rs2imm_str + \
             f" op: {instr.get_opcode():x} func3: {instr.funct3} func7: {instr.funct7}" + \
-            f" alu_fun: {alufun_tup[0]}\n"
+            f" alu_fun: {renum['ALU_fun'][ctrl.alu_fun]}\n"
 
 def branch_taken(op1, op2, br_fun):
     "check wether jump or branch AND if branch is taken or not by comparing op1 and op2"
@@ -113,19 +260,60 @@ def branch_taken(op1, op2, br_fun):
         return 0
     elif br_fun == 1: # jr
         return 1
-    elif br_fun == 2 or br_fun == 5: # bgeu and bge
+    elif br_fun == 6: # jump
+        return 3
+    # registers can hold signed or unsigned values, compare the 32-bit values
+    op1 = as_twos_comp(op1); op2 = as_twos_comp(op2)
+    if br_fun == 2: # bgeu
         return 2 if op1 >= op2 else 0
+    elif br_fun == 5: # bge
+        return 2 if sextend(op1) >= sextend(op2) else 0
     elif br_fun == 3: # blt
-        return 2 if op1 < op2 else 0
+        return 2 if sextend(op1) < sextend(op2) else 0
     elif br_fun == 7: # bltu
         return 2 if op1 < op2 else 0
     elif br_fun == 4: # bne
         return 2 if op1 != op2 else 0
-    elif br_fun == 6: # jump
-        return 3
     elif br_fun == 8: # beq
         return 2 if op1 == op2 else 0
 
+if BLOCKS or FUNC:
+    # translate and run whole basic blocks or run the functional handlers,
+    # there is no per cycle trace so the registers can live in a 32-bit array
+    RF = ArrayRegFile()
+    if JIT:
+        ENGINE = JitEngine(MEM, RF, HOST,
+            dump = sys.stdout if DUMP else None, check = CHECK)
+    elif BLOCKS:
+        ENGINE = BlockEngine(MEM, RF, HOST, trace = TRACE, trigger = TRIGGER)
+    else:
+        ENGINE = FunctionalEngine(MEM, RF, HOST, STATS, CALLS, TRACE, TRIGGER)
+    pc = symbols["_start"]
+    if RESTORED:
+        ENGINE.instret = RESTORED.instret
+        pc = restore(ENGINE.csrs, RESTORED.instret)
+    try:
+        if CKPT_AT != None:
+            pc = ENGINE.run(pc, max(CKPT_AT - ENGINE.instret, 0))
+            if pc != None: save_checkpoint(pc, ENGINE.instret)
+        if PROF:
+            # run in chunks, sampling the pc each chunk stops at
+            while pc != None:
+                pc = ENGINE.run(pc, PROF.interval)
+                if pc != None: PROF.sample(pc)
+        elif pc != None:
+            ENGINE.run(pc)
+    except Halt as h:
+        handle_exit(h.code)
+    if DEBUG: print("Done -- end of program.\n")
+    handle_exit()
+
+# the datapath counts cycles from the restore, the counter csrs continue
+BASE = 0
+if RESTORED:
+    restore(CSR, 0)
+    BASE = RESTORED.instret
+
 startup = True
 # generate system clocks until we reach a stopping condition
 # this is basically the run function from the last lab
@@ -135,17 +323,45 @@ for t in itertools.count():
 
     # RESET the PC register
     if startup:
-        PC.reset(symbols["_start"])
+        PC.reset(RESTORED.pc if RESTORED else symbols["_start"])
         startup = False
         if DEBUG: print(f"{t}:", display())
         continue
 
-    # access instruction memory
-    instr = Instruction(imem[pc_val], pc_val)
+    if CKPT_AT != None and BASE + t - 1 == CKPT_AT: save_checkpoint(pc_val, CKPT_AT)
+
+    # access instruction memory through the decode cache
+    instr = ICACHE.fetch(pc_val)
+    if STATS: STATS.retire(instr.instr)
+    if PROF and t % PROF.interval == 0: PROF.sample(pc_val)
+    # whether this instruction is traced, checked before it runs as a call changes ra
+    traced = TRIGGER == None or TRIGGER.check(pc_val, as_twos_comp(RF.read(1)) or 0)
+    SHOW = DEBUG and traced
+
+    # csr calls read the old value into rd and write rs1 (or the zimm) to the csr
+    if instr.instr.startswith("csr"):
+        addr = instr.val >> 20
+        src = instr.rs1 if instr.instr.endswith('i') else as_twos_comp(RF.read(instr.rs1)) or 0
+        old = CSR.execute(instr.instr, addr, instr.rs1, src)
+        RF.clock(instr.rd, old, 1)
+        if TRACE and traced: TRACE.record(pc_val, instr.val, old if instr.rd else 0, 0)
+        if SHOW: print(f"{t}: PC: {pc_val:08x}, IR: {instr.val:08x}, {instr.instr} " +
+                        f"{CSR.name(addr)} -- {old:x} [{instr.rd}]\n")
+        PC.clock(4 + pc_val)
+        continue
+
+    # no op mret
+    if instr.instr == 'mret':
+        if SHOW: print(f"{t}: PC: {pc_val:08x}, IR: {instr.val:08x}, {instr.instr} -- no-op\n")
+        if TRACE and traced: TRACE.record(pc_val, instr.val, 0, 0)
+        PC.clock(4 + pc_val)
+        continue
 
-    # no op csr calls
-    if instr.instr.startswith("csr") or instr.instr == 'mret':
-        if DEBUG: print(f"{t}: PC: {pc_val:08x}, IR: {instr.val:08x}, {instr.instr} -- no-op\n")
+    # fence.i makes earlier stores visible to fetch, drop all decoded instrs
+    if instr.instr == 'fence.i':
+        if SHOW: print(f"{t}: PC: {pc_val:08x}, IR: {instr.val:08x}, {instr.instr} -- flush\n")
+        if TRACE and traced: TRACE.record(pc_val, instr.val, 0, 0)
+        ICACHE.flush()
         PC.clock(4 + pc_val)
         continue
 
@@ -159,75 +375,102 @@ for t in itertools.count():
     if instr.rs2 != None:
         rs2_val = RF.read(instr.rs2)
 
-    # define the op1, op2 muxes
-    op1_mux = make_mux(lambda: rs1_val, lambda: None, lambda: instr.imm)
-    op2_mux = make_mux(lambda: rs2_val, lambda: instr.imm, lambda: instr.imm, lambda: pc_val)
-
-    # get the alu fun val using decoder
-    alufun_tup = controlFormatter(instr.get_instr(), "ALU_fun")
+    # the control signals were precompiled for the instruction by the decoder
+    ctrl = instr.ctrl
     # get the op1 and op2 sel
-    op1_sel = controlFormatter(instr.get_instr(), "op1_sel")[1]
-    op2_sel = controlFormatter(instr.get_instr(), "op2_sel")[1]
+    op1_sel = ctrl.op1_sel
+    op2_sel = ctrl.op2_sel
+
+    # the op1, op2 muxes
+    if FAST:
+        OP1_IN[0] = rs1_val; OP1_IN[2] = instr.imm
+        OP2_IN[0] = rs2_val; OP2_IN[1] = OP2_IN[2] = instr.imm; OP2_IN[3] = pc_val
+        op1_val = OP1_IN[op1_sel]
+        op2_val = OP2_IN[op2_sel]
+    else:
+        op1_mux = make_mux(lambda: rs1_val, lambda: None, lambda: instr.imm)
+        op2_mux = make_mux(lambda: rs2_val, lambda: instr.imm, lambda: instr.imm, lambda: pc_val)
+        op1_val = op1_mux(op1_sel)
+        op2_val = op2_mux(op2_sel)
 
     # perform the alu operation
-    alu_val = alu(op1_mux(op1_sel), op2_mux(op2_sel), alufun_tup[1])
+    alu_val = alu(op1_val, op2_val, ctrl.alu_fun)
 
-    # read data memory -> get addr from alu
-    rdata = lambda: MEM.out(alu_val)
+    # the mask type selects the typed load/store (size and sign extension),
+    # the decode cache bound them to the instruction
+    mask_type = ctrl.mask_type
+    load = instr.load
 
     # get mem write and mem em
-    mem_em = controlFormatter(instr.get_instr(), "mem_em")[1]
-    mem_wr = controlFormatter(instr.get_instr(), "mem_wr")[1]
+    mem_em = ctrl.mem_em
+    mem_wr = ctrl.mem_wr
     # write data from alu to memory
-    MEM.clock(alu_val, rs2_val, mem_wr)
     if mem_wr:
-        if DEBUG: print(f"dmem_write @ 0x{alu_val:08x} to value 0x{MEM.out(alu_val):08x}")
+        instr.store(alu_val, rs2_val)
+        # drop any decoded instruction the store overwrote
+        ICACHE.invalidate(alu_val, mask_type)
+        if SHOW: print(f"dmem_write @ 0x{alu_val:08x} to value 0x{MEM.out(alu_val):08x}")
     
-    # define the wb mux
-    wb_mux = make_mux(lambda: 4 + pc_val, lambda: alu_val, rdata, lambda: None)
     # get wb_sel
-    wb_sel = controlFormatter(instr.get_instr(), "wb_sel")[1]
+    wb_sel = ctrl.wb_sel
+    # the wb mux, data memory is only read (addr from alu) when it is selected
+    if FAST:
+        WB_IN[0] = 4 + pc_val; WB_IN[1] = alu_val
+        WB_IN[2] = load(alu_val) if wb_sel == 2 else None
+        wb_val = WB_IN[wb_sel]
+    else:
+        rdata = lambda: load(alu_val)
+        wb_mux = make_mux(lambda: 4 + pc_val, lambda: alu_val, rdata, lambda: None)
+        wb_val = wb_mux(wb_sel)
 
     # get rf_wen
-    rf_wen = controlFormatter(instr.get_instr(), "rf_wen")[1]
+    rf_wen = ctrl.rf_wen
     # update register values
-    RF.clock(instr.rd, wb_mux(wb_sel), rf_wen)
+    RF.clock(instr.rd, wb_val, rf_wen)
 
     # print one line at the end of the clock cycle
-    if DEBUG: print(f"{t}:", display())
+    if SHOW: print(f"{t}:", display())
+    # record the retired instruction, the written value and the data address
+    if TRACE and traced: TRACE.record(pc_val, instr.val, RF.read(instr.rd) or 0 if instr.rd else 0,
+                           alu_val if mem_em else 0)
 
     # handle env calls
-    # check a0 value env call type
-    a0_val = RF.read(10)
-    if instr.instr == 'ecall' and a0_val == 1:
-        if DEBUG: print(f"ECALL({a0_val}): {RF.read(11)}\n")
-        else: print(f"{elf_path} output -- {RF.read(11)}")
-    elif instr.instr == 'ecall' and (a0_val == 0 or a0_val == 10):
-        if DEBUG: 
-            print(f"ECALL({a0_val}): " + 'EXIT\n' if a0_val == 10 else f"ECALL({a0_val}): " + 'HALT\n')
-            RF.display()
-        handle_test()
-        break
+    # the a0 value (or a7 for the exit syscall) selects the env call type
+    if instr.instr == 'ecall':
+        try:
+            HOST.ecall(RF.read(10), RF.read(11), RF.read(17))
+        except Halt as h:
+            handle_exit(h.code)
 
     # check for UCB syscalls and handle them
     handle_syscall(mem_em, mem_wr, alu_val)
     
-    # define the pc mux
-    pc_mux = make_mux(lambda: 4 + pc_val, lambda: instr.imm + as_twos_comp(rs1_val), lambda: instr.imm + pc_val, lambda: instr.imm + pc_val, lambda: None)
-
     # get branch type
-    br_type = controlFormatter(instr.get_instr(), "br_type")[1]
+    br_type = ctrl.br_type
     # get the pc sel based on instr type and whether branch is taken on not
-    pc_sel = branch_taken(op1_mux(op1_sel), op2_mux(op2_sel), br_type)
+    pc_sel = branch_taken(op1_val, op2_val, br_type)
+
+    # the pc mux, jump targets are only computed when selected
+    if FAST:
+        PC_IN[0] = 4 + pc_val
+        if pc_sel == 1:
+            PC_IN[1] = instr.imm + as_twos_comp(rs1_val)
+        elif pc_sel > 1:
+            PC_IN[2] = PC_IN[3] = instr.imm + pc_val
+        next_pc = PC_IN[pc_sel]
+    else:
+        pc_mux = make_mux(lambda: 4 + pc_val, lambda: instr.imm + as_twos_comp(rs1_val), lambda: instr.imm + pc_val, lambda: instr.imm + pc_val, lambda: None)
+        next_pc = pc_mux(pc_sel)
+
+    # count the control transfers that left the fall through path
+    if STATS and next_pc != 4 + pc_val: STATS.retire_taken(instr.instr)
+    # follow calls and returns
+    if CALLS and br_type in (1, 6): CALLS.transfer(instr, next_pc, t - 1)
 
     # clock logic blocks, PC is the only clocked module!
-    PC.clock(pc_mux(pc_sel))
+    PC.clock(next_pc)
 
     # check stopping conditions on NEXT instruction
     if imem[PC.out()] == 0:
-        if DEBUG: 
-            print("Done -- end of program.\n")
-            # print register values at the end of program
-            RF.display()
-        handle_test()
-        break
+        if DEBUG: print("Done -- end of program.\n")
+        handle_exit()
@@ -0,0 +1,223 @@
+"""
+profiler.py
+===========
+Guest program profilers for the onestage simulator.
+
+SamplingProfiler records the guest pc every *interval* retired instructions
+in a histogram array with one counter per instruction word of the code
+segments. The engines are simply run in chunks of interval instructions
+and the pc they stop at is sampled, so nothing is added to their loops.
+At exit the histogram is resolved against the elf symbols into a flat
+per-function profile or collapsed stacks for flame graph tools
+(flamegraph.pl, speedscope, ...).
+
+CallGraphProfiler keeps a shadow call stack instead. It is only told about
+calls (jal/jalr with rd = ra) and returns (jalr x0, 0(ra)) together with the
+retire count, and charges the instructions retired since the last call or
+return to the current stack, so straight-line code costs nothing. The
+result is a call tree with inclusive and exclusive counts per function and
+exact collapsed stacks.
+"""
+import bisect
+from array import array
+from elftools.elf.constants import P_FLAGS
+from pydigital.elfloader import Elf
+
+# default instructions between samples
+INTERVAL = 1000
+
+class SymbolTable:
+    "resolves guest code addresses to the function (or label) containing them"
+    def __init__(self, elffile):
+        with Elf(elffile, quiet = True) as e:
+            self.funcs = e.functions()
+            # the address range of the executable segments
+            text = [(seg['p_vaddr'], seg['p_vaddr'] + seg['p_memsz'])
+                    for seg in e.ef.iter_segments()
+                    if seg['p_type'] == 'PT_LOAD' and seg['p_flags'] & P_FLAGS.PF_X]
+        self.addrs = [f[0] for f in self.funcs]
+        self.text = (min(t[0] for t in text), max(t[1] for t in text)) if text else (0, 0)
+
+    def lookup(self, pc):
+        "the name of the function containing pc, a hex address if there is none"
+        k = bisect.bisect_right(self.addrs, pc) - 1
+        if k >= 0:
+            addr, size, name = self.funcs[k]
+            if not size or pc < addr + size:
+                return name
+        return f"0x{pc:08x}"
+
+class SamplingProfiler:
+    "pc histogram sampled every interval retired instructions"
+    def __init__(self, elffile, interval = INTERVAL):
+        """
+        elffile is the program being profiled, its symbols name the functions
+        and interval is the number of retired instructions between samples
+        """
+        self.symbols = SymbolTable(elffile)
+        self.interval = interval
+        self.base, end = self.symbols.text
+        self.hist = array('Q', bytes(8 * ((end - self.base + 3) >> 2)))
+        self.other = {}      # pc -> samples, for pcs outside the code segments
+        self.samples = 0
+
+    def sample(self, pc):
+        "record one sample at pc"
+        self.samples += 1
+        try:
+            self.hist[(pc - self.base) >> 2] += 1
+        except (IndexError, OverflowError):
+            self.other[pc] = self.other.get(pc, 0) + 1
+
+    def counts(self):
+        "the samples per pc, a dict"
+        base = self.base
+        counts = {base + 4*k: c for k, c in enumerate(self.hist) if c}
+        for pc, c in self.other.items():
+            counts[pc] = counts.get(pc, 0) + c
+        return counts
+
+    def flat(self):
+        "the samples per function, a list of (name, samples) with the most sampled first"
+        funcs = {}
+        lookup = self.symbols.lookup
+        for pc, c in self.counts().items():
+            name = lookup(pc)
+            funcs[name] = funcs.get(name, 0) + c
+        return sorted(funcs.items(), key = lambda kv: -kv[1])
+
+    def report(self):
+        "the flat profile as a printable table"
+        total = self.samples or 1
+        lines = [f"{self.samples} samples, one every {self.interval} instructions",
+                 f"{'self':>10s} {'%':>7s}  function"]
+        for name, c in self.flat():
+            lines.append(f"{c:10d} {100 * c / total:6.2f}%  {name}")
+        return "\n".join(lines)
+
+    def collapsed(self):
+        "collapsed stacks (one frame per sample, the function sampled)"
+        return "".join(f"{name} {c}\n" for name, c in self.flat())
+
+    def __str__(self):
+        return self.report()
+
+def call_kind(instr):
+    "'call' or 'ret' for the jumps the call graph follows, None for everything else"
+    name = instr.instr
+    if name == 'jal' or name == 'jalr':
+        if instr.rd == 1:
+            return 'call'
+        if name == 'jalr' and instr.rd == 0 and instr.rs1 == 1 and instr.imm == 0:
+            return 'ret'
+    return None
+
+class CallGraphProfiler:
+    "shadow call stack charging retired instructions to guest functions"
+    def __init__(self, elffile, entry):
+        """
+        elffile is the program being profiled, its symbols name the functions
+        and entry is the pc the program starts at (the bottom frame)
+        """
+        self.symbols = SymbolTable(elffile)
+        # the stack is a tuple of function names, paths[stack] its own instructions
+        self.stack = (self.symbols.lookup(entry),)
+        self.paths = {}
+        self.last = 0        # retire count up to which instructions were charged
+        self.calls = 0
+        self.unmatched = 0   # returns with no frame to pop
+
+    def charge(self, retired):
+        "charge the instructions up to a retire count of retired to the current stack"
+        self.paths[self.stack] = self.paths.get(self.stack, 0) + retired - self.last
+        self.last = retired
+
+    def call(self, target, retired):
+        "a call to target, retired instructions retired before it (the call is the caller's)"
+        self.charge(retired + 1)
+        self.stack += (self.symbols.lookup(target),)
+        self.calls += 1
+
+    def ret(self, retired):
+        "a return, retired instructions retired before it (the return is the callee's)"
+        self.charge(retired + 1)
+        if len(self.stack) > 1:
+            self.stack = self.stack[:-1]
+        else:
+            self.unmatched += 1
+
+    def transfer(self, instr, target, retired):
+        "follow a retired instruction that jumped to target, for callers that don't classify"
+        kind = call_kind(instr)
+        if kind == 'call':
+            self.call(target, retired)
+        elif kind == 'ret':
+            self.ret(retired)
+
+    def finish(self, retired):
+        "charge the instructions retired since the last call or return, at exit"
+        self.charge(retired)
+
+    def functions(self):
+        "per function (inclusive, exclusive) counts, a dict"
+        funcs = {}
+        for path, count in self.paths.items():
+            # recursion counts once towards inclusive
+            for name in set(path):
+                inc, exc = funcs.get(name, (0, 0))
+                funcs[name] = (inc + count, exc)
+            inc, exc = funcs[path[-1]]
+            funcs[path[-1]] = (inc, exc + count)
+        return funcs
+
+    def tree(self):
+        "the call tree as a printable table of inclusive and exclusive counts"
+        # inclusive count of every stack prefix
+        nodes = {}
+        for path, count in self.paths.items():
+            for k in range(1, len(path) + 1):
+                inc, exc = nodes.get(path[:k], (0, 0))
+                nodes[path[:k]] = (inc + count, exc + (count if k == len(path) else 0))
+        children = {}
+        for path in nodes:
+            children.setdefault(path[:-1], []).append(path)
+        total = sum(self.paths.values()) or 1
+        lines = [f"{sum(self.paths.values())} instructions, {self.calls} calls",
+                 f"{'inclusive':>10s} {'%':>7s} {'exclusive':>10s}  function"]
+        def walk(path):
+            inc, exc = nodes[path]
+            lines.append(f"{inc:10d} {100 * inc / total:6.2f}% {exc:10d}  " +
+                         "  " * (len(path) - 1) + path[-1])
+            for child in sorted(children.get(path, ()), key = lambda p: -nodes[p][0]):
+                walk(child)
+        for root in sorted(children.get((), ()), key = lambda p: -nodes[p][0]):
+            walk(root)
+        return "\n".join(lines)
+
+    def report(self):
+        "the call tree followed by the per function totals"
+        total = sum(self.paths.values()) or 1
+        lines = [self.tree(), "", f"{'inclusive':>10s} {'%':>7s} {'exclusive':>10s} {'%':>7s}  function"]
+        for name, (inc, exc) in sorted(self.functions().items(), key = lambda kv: -kv[1][1]):
+            lines.append(f"{inc:10d} {100 * inc / total:6.2f}% {exc:10d} {100 * exc / total:6.2f}%  {name}")
+        return "\n".join(lines)
+
+    def collapsed(self):
+        "collapsed stacks, one line per call stack with its own instructions"
+        return "".join(f"{';'.join(path)} {count}\n" for path, count
+                       in sorted(self.paths.items()) if count)
+
+    def __str__(self):
+        return self.report()
+
+# testbench, profile an elf on the functional engine
+if __name__=="__main__":
+    import sys
+    from simulator import Simulator
+    if len(sys.argv) < 2:
+        exit("ERROR: input elf file not provided!")
+    sim = Simulator(profile = 100, calls = True).load_elf(sys.argv[1])
+    print(sim.run())
+    print(sim.profiler)
+    print()
+    print(sim.calls)
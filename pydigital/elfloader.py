@@ -45,6 +45,22 @@ class Elf():
     def entry_point(self):
         return self.ef["e_entry"]
 
+    def functions(self):
+        "the code symbols (functions and labels in executable sections) as a sorted list of (addr, size, name)"
+        funcs = {}
+        for sym in self.symtab.iter_symbols():
+            kind = sym['st_info']['type']
+            shndx = sym['st_shndx']
+            if not sym.name or kind not in ('STT_FUNC', 'STT_NOTYPE') or type(shndx) is not int:
+                continue
+            if not self.ef.get_section(shndx)['sh_flags'] & elfconst.SH_FLAGS.SHF_EXECINSTR:
+                continue
+            addr = sym['st_value']
+            # prefer a sized function over a label at the same address
+            if addr not in funcs or kind == 'STT_FUNC':
+                funcs[addr] = (addr, sym['st_size'], sym.name)
+        return sorted(funcs.values())
+
     def segments(self):
         if not self.quiet:
             print( '  --- SEGMENTS ---')
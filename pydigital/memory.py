@@ -3,65 +3,144 @@ memory.py
 =========
 Provides a byte-addressed memory.
 """
-from pydigital.utils import sextend
+import struct
+
+# ELFMemory finds segments through a table of 4 KiB pages
+PAGE_BITS = 12
+
+class MemoryFault(IndexError):
+    "access to an address that no memory segment holds"
+    def __init__(self, addr, write = False):
+        self.addr = addr
+        self.write = write
+        kind = "Write to" if write else "Read from"
+        super().__init__(f"{kind} address {addr:08x} not found in memory.")
+
+# struct codes for unsigned 1/2/4/8 byte accesses
+_codes = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+_masks = {n: (1 << 8*n) - 1 for n in _codes}
+# mask_type control values, the low bits are the byte count and
+# MT_UNSIGNED marks a zero extended load (see riscv_isa.decoder)
+MT_B, MT_H, MT_W = 1, 2, 4
+MT_UNSIGNED = 0b1000
+MT_BU, MT_HU = MT_B | MT_UNSIGNED, MT_H | MT_UNSIGNED
 class Memory:
     "Memory module which implements the risc-v sodor memory interface"
     def __init__(self, segment = None):
         "initialize with a memory segment"
         self.mem = segment
+        # typed accesses indexed by mask_type, pick one at decode time
+        self.loads = {MT_B: self.load_b, MT_BU: self.load_bu, MT_H: self.load_h,
+                      MT_HU: self.load_hu, MT_W: self.load_w}
+        self.stores = {MT_B: self.store_b, MT_BU: self.store_b, MT_H: self.store_h,
+                       MT_HU: self.store_h, MT_W: self.store_w}
+    def loader(self, mask_type):
+        "the load function for a mask_type control value"
+        return self.loads[mask_type]
+    def storer(self, mask_type):
+        "the store function for a mask_type control value"
+        return self.stores[mask_type]
+    # loads return the sign (or zero) extended value read from exactly the bytes needed
+    def load_b(self, addr):
+        "load a signed byte"
+        return (self.mem.load(addr, 1) ^ 0x80) - 0x80
+    def load_bu(self, addr):
+        "load an unsigned byte"
+        return self.mem.load(addr, 1)
+    def load_h(self, addr):
+        "load a signed half word"
+        return (self.mem.load(addr, 2) ^ 0x8000) - 0x8000
+    def load_hu(self, addr):
+        "load an unsigned half word"
+        return self.mem.load(addr, 2)
+    def load_w(self, addr):
+        "load a (signed) word"
+        return (self.mem.load(addr, 4) ^ 0x80000000) - 0x80000000
+    # stores write the low bytes of data
+    def store_b(self, addr, data):
+        "store a byte"
+        self.mem.store(addr, data, 1)
+    def store_h(self, addr, data):
+        "store a half word"
+        self.mem.store(addr, data, 2)
+    def store_w(self, addr, data):
+        "store a word"
+        self.mem.store(addr, data, 4)
     def out(self, addr, byte_count = 4, signed = True):
         "read access"
         if addr == None:
             return None
-        #TODO check of byte_count is larger than word size, that won't work!
-        if signed:
-            f = sextend
-        else:
-            f = lambda x, c: x
-        if byte_count == 1:
-            return f(self.mem[addr] & 0xff, 8)
-        elif byte_count == 2:
-            return f(self.mem[addr] & 0xffff, 16)
-        elif byte_count == 4:
-            return f(self.mem[addr] & 0xffffffff, 32)
-        elif byte_count == 8:
-            return self.mem[addr] & 0xffffffffffffffff
-        else:
+        if byte_count not in (1, 2, 4, 8):
             raise ValueError("Mem can only access Bytes/Half Words/Words.")
+        if signed and byte_count < 8:
+            return self.loads[byte_count](addr)
+        return self.mem.load(addr, byte_count)
     def clock(self, addr, data, mem_rw = 0, byte_count = 4):
         "synchronous write, mem_rw=1 for write"
         if mem_rw == 1:
-            mask = (2**(byte_count*8))-1
-            #print(f"MEM write mask {mask:08x} masked val is {(mask&data):08x} of {byte_count} bytes")
-            # mask out any upper bits so to_bytes doesn't complain
-            val = (mask & data).to_bytes(length=byte_count,
-                byteorder = self.mem.byteorder, signed = False)
-            #print(f'MEM val is {val}')
-            self.mem[addr] = val
+            # the store masks out any upper bits
+            self.mem.store(addr, data, byte_count)
 class ELFMemory:
-    "ELFMemory is a collection of memory segments that supports get/set"
+    """
+    ELFMemory is a collection of memory segments that supports get/set.
+    Addresses are translated through a page table (page number -> segments
+    overlapping that page) behind a one entry cache of the last segment hit,
+    so the cost of an access does not grow with the number of segments.
+    """
     def __init__(self):        
         self.mems = []
         self.byteorder = None
+        self.pages = {}
+        # the last segment hit, starts as an empty one that never matches
+        self.last = MemorySegment(0, data = bytearray())
+    def segment(self, i, write = False):
+        "return the segment holding byte address i, raises MemoryFault if there is none"
+        for m in self.pages.get(i >> PAGE_BITS, ()):
+            if m.begin_addr <= i < m.end_addr:
+                self.last = m
+                return m
+        raise MemoryFault(i, write)
     def __getitem__(self, i):
-        if i == None: 
-            return None
-        for m in self.mems:
-            if i in m:
+        m = self.last
+        try:
+            if m.begin_addr <= i < m.end_addr:
                 return m[i]
-        raise IndexError(f"Address {i:08x} not found in memory.")
+        except TypeError:
+            if i is None:
+                return None
+            if isinstance(i, slice):
+                return self.segment(i.start)[i]
+            raise
+        return self.segment(i)[i]
     def __setitem__(self, i, val):
-        if i == None:
+        if i is None:
             return
-        for m in self.mems:
-            if i in m:                  
-                m[i] = val
+        m = self.last
+        if not m.begin_addr <= i < m.end_addr:
+            m = self.segment(i, write = True)
+        m[i] = val
+    def load(self, i, size = 4):
+        "unsigned load of size (1, 2, 4 or 8) bytes from address i"
+        m = self.last
+        if not m.begin_addr <= i < m.end_addr:
+            m = self.segment(i)
+        return m.load(i, size)
+    def store(self, i, val, size = 4):
+        "store the low size (1, 2, 4 or 8) bytes of val at address i"
+        m = self.last
+        if not m.begin_addr <= i < m.end_addr:
+            m = self.segment(i, write = True)
+        m.store(i, val, size)
     def __iadd__(self, seg):
         if self.byteorder == None:
             self.byteorder = seg.byteorder      
         elif self.byteorder != seg.byteorder:
             raise ValueError("Byteorder does not match previous segments.")
         self.mems.append(seg)
+        # map every page the segment touches
+        for page in range(seg.begin_addr >> PAGE_BITS,
+                ((seg.end_addr - 1) >> PAGE_BITS) + 1):
+            self.pages[page] = self.pages.get(page, ()) + (seg,)
         return self
     def begin_addr(self):
         "return the lowest begin address included"
@@ -98,45 +177,69 @@ class MemorySegment:
                 self.data = bytearray(data)
         self.end_addr = begin_addr + len(self.data)
         self.begin_addr = begin_addr
+        self._bind()
+    def _bind(self):
+        "build the memoryview and the precompiled endian specific access paths"
+        self.view = memoryview(self.data)
+        order = '<' if self.byteorder == 'little' else '>'
+        structs = {n: struct.Struct(order + c) for n, c in _codes.items()}
+        # index by access size, eg. self._load[2] reads an unsigned half word
+        self._load = {n: st.unpack_from for n, st in structs.items()}
+        self._store = {n: st.pack_into for n, st in structs.items()}
+        self._load_word = self._load.get(self.word_size)
+        self._store_word = self._store.get(self.word_size)
+    def __getstate__(self):
+        # memoryviews and bound struct methods can't be copied or pickled
+        state = self.__dict__.copy()
+        for k in ('view', '_load', '_store', '_load_word', '_store_word'):
+            del state[k]
+        return state
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._bind()
     def __str__(self):
         return f"Memory[{self.begin_addr:8x}:{self.end_addr:8x}] ({len(self.data)})"
+    def load(self, i, size = 4):
+        "unsigned load of size (1, 2, 4 or 8) bytes from *byte* address i"
+        try:
+            return self._load[size](self.view, i - self.begin_addr)[0]
+        except struct.error:
+            # runs off the end of the segment, return the bytes that are there
+            i -= self.begin_addr
+            return int.from_bytes(self.data[i: i+size], byteorder=self.byteorder)
+    def store(self, i, val, size = 4):
+        "store the low size (1, 2, 4 or 8) bytes of val at *byte* address i"
+        self._store[size](self.view, i - self.begin_addr, val & _masks[size])
     def __getitem__(self, i):
         "get a word from a given *byte* address"
-        if i == None:
-            return None
-        if isinstance(i, slice):
-            # if you ask for a slice, you get raw bytes
-            data = self.data[i.start - self.begin_addr: i.stop - self.begin_addr: i.step]            
-            return data
-            # this decodes, but that's less useful
-            #return [int.from_bytes(data[_i:_i+self.word_size], byteorder=self.byteorder, signed=False) \
-                    #for _i in data[::self.word_size]]
-        else:
-            try:
-                i -= self.begin_addr
-            except TypeError as err:
-                print("can't access", i)
-                raise err
+        try:
             # returns the given word size value as an unsigned int (preserving 2s comp)
+            return self._load_word(self.view, i - self.begin_addr)[0]
+        except struct.error:
+            # runs off the end of the segment
+            i -= self.begin_addr
             return int.from_bytes(
                 self.data[i: i+self.word_size],
                 byteorder=self.byteorder, signed=False)
+        except TypeError:
+            if i is None:
+                return None
+            if isinstance(i, slice):
+                # if you ask for a slice, you get raw bytes
+                return self.data[i.start - self.begin_addr: i.stop - self.begin_addr: i.step]
+            raise
     def __setitem__(self, i, val, signed=False):
-        "set a word at given *byte* address"
-        if type(val) == int:
-            # convert to a words/bytes
-            val = val.to_bytes(length=self.word_size, 
-                byteorder=self.byteorder, signed=signed)
-        if type(val) == bytes or type(val) == bytearray:
-            # print('setting bytes', val)
-            # byte by byte copy
-            i -= self.begin_addr
-            for v in val:
-                self.data[i] = v
-                i += 1 
+        "set a word (int) or raw bytes at given *byte* address"
+        i -= self.begin_addr
+        if type(val) is int:
+            if signed:
+                val &= _masks[self.word_size]
+            self._store_word(self.view, i, val)
+        elif type(val) is bytes or type(val) is bytearray:
+            # one slice copy, the view can't grow so a store off the end fails
+            self.view[i: i+len(val)] = val
         else:
             raise ValueError("Value must be bytes or int.")
-        # self.data[(i - self.begin_addr) // self.word_size] = self.fromTwosComp(val)
     def __contains__(self, addr):
         "is the given byte address in this memory segment?"
         if isinstance(addr, slice):
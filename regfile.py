@@ -1,5 +1,10 @@
+from array import array
 from riscv_isa.isa import regNumToName
 
+MASK = 0xffffffff
+# array type code of an unsigned 32-bit int
+_code = 'I' if array('I').itemsize == 4 else 'L'
+
 class RegFile:
     def __init__(self):
         """
@@ -30,6 +35,38 @@ class RegFile:
                   for i in range(y, y+4)]))
         print()
 
+class ArrayRegFile(RegFile):
+    def __init__(self):
+        """
+        Represents a register file backed by a 32-bit unsigned array
+        regs is the register array, all registers start at 0 and
+        values are stored masked to 32 bits
+        """
+        self.regs = array(_code, bytes(4 * 32))
+
+    # reads need no checks, there are no undefined registers
+    def read(self, addr):
+        return self.regs[addr]
+
+    # a write with no branches, x0 is zeroed again so it stays hardwired
+    def write(self, addr, val):
+        regs = self.regs
+        regs[addr] = val & MASK
+        regs[0] = 0
+
+    # the clocked writer keeps the RegFile interface
+    def clock(self, addr, val, en):
+        if en and val != None:
+            self.write(addr, val)
+
+    # a copy of all the registers as 128 bytes
+    def snapshot(self):
+        return self.regs.tobytes()
+
+    # restore a snapshot in place (one buffer copy, users may hold self.regs)
+    def restore(self, snap):
+        memoryview(self.regs).cast('B')[:] = snap
+
 # testbench for regfile
 if __name__=="__main__":
     # instantiate the reg file class
@@ -43,4 +80,13 @@ if __name__=="__main__":
         regfile.clock(addr, 0x42 + addr, True)
         addr += 1
     # display the register
-    regfile.display()
\ No newline at end of file
+    regfile.display()
+
+    # the array backed reg file, x0 can't be written
+    regfile = ArrayRegFile()
+    snap = regfile.snapshot()
+    for addr in range(32):
+        regfile.write(addr, -addr)
+    regfile.display()
+    regfile.restore(snap)
+    regfile.display()
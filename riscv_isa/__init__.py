@@ -1 +1,2 @@
-from .isa import Instruction, BadInstruction
\ No newline at end of file
+from .isa import Instruction, BadInstruction
+from .icache import DecodeCache
\ No newline at end of file
@@ -49,6 +49,10 @@ csrs = [
   (0xC1D, 'hpmcounter29'),
   (0xC1E, 'hpmcounter30'),
   (0xC1F, 'hpmcounter31'),
+  # RV32 upper halves of the counters
+  (0xC80, 'cycleh'),
+  (0xC81, 'timeh'),
+  (0xC82, 'instreth'),
   (0xC20, 'vl'),
   (0xC21, 'vtype'),
   (0xC22, 'vlenb'),
@@ -187,6 +191,8 @@ csrs = [
   (0xB1D, 'mhpmcounter29'),
   (0xB1E, 'mhpmcounter30'),
   (0xB1F, 'mhpmcounter31'),
+  (0xB80, 'mcycleh'),
+  (0xB82, 'minstreth'),
   (0x323, 'mhpmevent3'),
   (0x324, 'mhpmevent4'),
   (0x325, 'mhpmevent5'),
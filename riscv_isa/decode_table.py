@@ -0,0 +1,129 @@
+"""
+decode_table.py
+===============
+Table driven instruction decoder.
+
+The nested instr dict is flattened once into a table keyed by the opcode,
+funct3 and funct7 bits of the word (val & KEY_MASK), so decoding is one dict
+lookup followed by the operand extraction for the instruction format. The
+result is a compact Decoded record with the same fields as Instruction plus
+the mnemonic id and the control signals (decoder.signals).
+"""
+from collections import namedtuple
+from .isa import instr_dict, instr_format
+from .decoder import signals
+
+# opcode | funct3 | funct7 bits of an instruction word
+KEY_MASK = 0xfe00707f
+
+# mnemonic ids, in the order they appear in the instr dict (0 is not an instruction)
+mnemonics = [None]
+# (mnemonic id, opcode, funct3, funct7), None matches any value of a field
+keys = []
+for _op, _obj in instr_dict.items():
+    if type(_obj) == str:
+        keys.append((len(mnemonics), _op, None, None))
+        mnemonics.append(_obj)
+        continue
+    for _f3, _obj3 in _obj.items():
+        if type(_obj3) == str:
+            keys.append((len(mnemonics), _op, _f3, None))
+            mnemonics.append(_obj3)
+            continue
+        for _f7, _name in _obj3.items():
+            keys.append((len(mnemonics), _op, _f3, _f7))
+            mnemonics.append(_name)
+mnemonics = tuple(mnemonics)
+
+Decoded = namedtuple('Decoded',
+    ['val', 'pc', 'id', 'instr', 'type', 'rd', 'rs1', 'rs2', 'imm', 'funct3', 'funct7', 'ctrl'])
+Decoded.__doc__ = "a decoded instruction, the fields match Instruction"
+
+# a decoder per table entry, built by the format's factory below
+# the constant fields are bound in the closure so decoding is one tuple build
+_new = tuple.__new__
+def _r(id, name, ctrl):
+    def dec(v, pc):
+        return _new(Decoded, (v, pc, id, name, 'r', v >> 7 & 0x1f, v >> 15 & 0x1f,
+            v >> 20 & 0x1f, None, v >> 12 & 0x7, v >> 25, ctrl))
+    return dec
+def _i(id, name, ctrl):
+    def dec(v, pc):
+        return _new(Decoded, (v, pc, id, name, 'i', v >> 7 & 0x1f, v >> 15 & 0x1f,
+            None, ((v >> 20) ^ 0x800) - 0x800, v >> 12 & 0x7, v >> 25, ctrl))
+    return dec
+def _s(id, name, ctrl):
+    def dec(v, pc):
+        imm = (v >> 20) & 0xfe0 | (v >> 7) & 0x1f
+        return _new(Decoded, (v, pc, id, name, 's', None, v >> 15 & 0x1f,
+            v >> 20 & 0x1f, (imm ^ 0x800) - 0x800, v >> 12 & 0x7, v >> 25, ctrl))
+    return dec
+def _b(id, name, ctrl):
+    def dec(v, pc):
+        imm = (v >> 19) & 0x1000 | (v << 4) & 0x800 | (v >> 20) & 0x7e0 | (v >> 7) & 0x1e
+        return _new(Decoded, (v, pc, id, name, 'sb', None, v >> 15 & 0x1f,
+            v >> 20 & 0x1f, (imm ^ 0x1000) - 0x1000, v >> 12 & 0x7, v >> 25, ctrl))
+    return dec
+def _u(id, name, ctrl):
+    def dec(v, pc):
+        return _new(Decoded, (v, pc, id, name, 'u', v >> 7 & 0x1f, None,
+            None, ((v & 0xfffff000) ^ 0x80000000) - 0x80000000, v >> 12 & 0x7, v >> 25, ctrl))
+    return dec
+def _j(id, name, ctrl):
+    def dec(v, pc):
+        imm = (v >> 11) & 0x100000 | v & 0xff000 | (v >> 9) & 0x800 | (v >> 20) & 0x7fe
+        return _new(Decoded, (v, pc, id, name, 'uj', v >> 7 & 0x1f, None,
+            None, (imm ^ 0x100000) - 0x100000, v >> 12 & 0x7, v >> 25, ctrl))
+    return dec
+def _none(id, name, ctrl):
+    # no format (eg. mret), Instruction still decodes rd and rs1
+    def dec(v, pc):
+        return _new(Decoded, (v, pc, id, name, None, v >> 7 & 0x1f, v >> 15 & 0x1f,
+            None, None, v >> 12 & 0x7, v >> 25, ctrl))
+    return dec
+_factories = {'r': _r, 'i': _i, 's': _s, 'sb': _b, 'u': _u, 'uj': _j, None: _none}
+
+# flat decode table, word & KEY_MASK -> decoder for that mnemonic
+table = {}
+for _id, _op, _f3, _f7 in keys:
+    _name = mnemonics[_id]
+    _dec = _factories[instr_format.get(_name)](_id, _name, signals.get(_name))
+    for _k3 in range(8) if _f3 is None else (_f3,):
+        for _k7 in range(128) if _f7 is None else (_f7,):
+            table[_k7 << 25 | _k3 << 12 | _op] = _dec
+
+def decode(val, pc = 0):
+    "decode the instruction word val at pc, raises KeyError if it isn't an instruction"
+    return table[val & KEY_MASK](val, pc)
+
+# testbench, checks decode against Instruction and compares decode throughput
+# on the riscv-test elfs
+if __name__=="__main__":
+    import glob, time
+    from pydigital.elfloader import Elf
+    from .isa import Instruction
+    words = []
+    for elffile in sorted(glob.glob('riscv_isa/programs/riscv-test/*')):
+        with Elf(elffile, quiet = True) as e:
+            for addr, size, data in e.segments():
+                for i in range(0, len(data) - 3, 4):
+                    val = int.from_bytes(data[i: i+4], e.byteorder)
+                    try:
+                        Instruction(val, addr + i)
+                    except KeyError:
+                        continue
+                    words.append((val, addr + i))
+    for val, pc in words:
+        ref, new = Instruction(val, pc), decode(val, pc)
+        for f in ('instr', 'type', 'rd', 'rs1', 'rs2', 'imm'):
+            assert getattr(ref, f) == getattr(new, f), f"{pc:08x}: {val:08x} {f}"
+    print(f"{len(words)} instruction words, decodes match Instruction")
+    for name, f in (('Instruction', Instruction), ('decode', decode)):
+        rounds = 20
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for val, pc in words:
+                f(val, pc)
+        elapsed = time.perf_counter() - start
+        n = rounds * len(words)
+        print(f"{name:12s} {n / elapsed / 1e3:8.1f} k decodes/s {1e9 * elapsed / n:8.1f} ns/decode")
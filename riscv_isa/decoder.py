@@ -4,6 +4,8 @@ riscv sodor collection. Copy-paste the output into the exported table
 to udpate.
 
 To use, import this file and use the *control* dictionary.
+The *signals* dictionary has the integer values the datapath needs as one
+Signals tuple per instruction, eg. signals["add"].alu_fun == 5.
 Each instruction (lowercase) has all control signals defined. 
 For each signal, look at *enums* this defines the enum value corresponding 
 to each integer value in the object (it may not match the sodor docs).
@@ -37,6 +39,8 @@ mask_type:MT_H
 csr_cmd:CSR.N
 """
 
+from collections import namedtuple
+
 # this is the raw compressed control table using the edited enums
 _c = """Inst    val_inst,br_type,op1_sel,op2_sel,ALU_fun,wb_sel,rf_wen,mem_em,mem_wr,mask_type,csr_cmd
 ADD	10005110043
@@ -64,9 +68,9 @@ FENCE_I	10000000043
 JAL	16000010043
 JALR	11010010043
 LB	10015211013
-LBU	10015211013
+LBU	10015211093
 LH	10015211023
-LHU	10015211023
+LHU	100152110a3
 LUI	10202110043
 LW	10015211043
 MRET	10000000042
@@ -90,6 +94,10 @@ WFI	10000000043
 XOR	10001110043
 XORI	10011110043"""
 
+# the control signals the datapath needs, in one immutable tuple
+Signals = namedtuple('Signals', ['br_type', 'op1_sel', 'op2_sel', 'alu_fun', 'wb_sel',
+    'rf_wen', 'mem_em', 'mem_wr', 'mask_type', 'csr_cmd'])
+
 class IControl:
     "instruction control helper class, decodes one compressed line of control signals"
     def __init__(self, fields, cstr, renums):
@@ -212,11 +220,12 @@ enums = {
             "M_XRD": 0,			
 			"M_XWR": 1
 		},
+		# low bits are the byte count, bit 3 marks an unsigned (zero extended) load
 		"mask_type": {
 			"MT_X": 4,
             "MT_H": 2,			
-			"MT_HU": 2,
-			"MT_BU": 1,
+			"MT_HU": 0xa,
+			"MT_BU": 9,
 			"MT_B": 1,
 			"MT_W": 4
 		},
@@ -263,3 +272,12 @@ else:
             fields = ctrl.split(',')
         else:
             control[instr.lower()] = IControl(fields, ctrl, renum)
+
+    # precompiled integer control signals for each instruction, built once so
+    # the datapath doesn't look up and translate the enums on every cycle
+    signals = {}
+    for instr, c in control.items():
+        signals[instr] = Signals(c.br_type, c.op1_sel, c.op2_sel, c.ALU_fun, c.wb_sel,
+            c.rf_wen, c.mem_em, c.mem_wr, c.mask_type, c.csr_cmd)
+    # the isa decoder names fence_i fence.i
+    signals['fence.i'] = signals['fence_i']
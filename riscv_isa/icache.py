@@ -0,0 +1,69 @@
+"""
+icache.py
+=========
+A decoded-instruction cache indexed by PC.
+
+Each word is decoded into an Instruction the first time it is fetched and
+reused on every later fetch of the same PC, so loops only pay for decode once.
+Stores that hit a cached code address drop the stale entry and fence.i
+flushes everything. Given the data memory, the typed load and store for the
+mask_type of each instruction are resolved when it is decoded too.
+"""
+from .isa import Instruction
+
+class DecodeCache:
+    "caches decoded instructions by pc in front of an instruction memory"
+    def __init__(self, mem, data = None):
+        """
+        mem is any byte addressed memory that returns a word for mem[pc],
+        data an optional sodor style Memory the instructions' load and store
+        are bound to
+        """
+        self.mem = mem
+        self.data = data
+        self.lines = {}
+        self.hits = 0
+        self.misses = 0
+    def fetch(self, pc):
+        "return the decoded instruction at pc, decoding it on the first fetch"
+        instr = self.lines.get(pc)
+        if instr is None:
+            self.misses += 1
+            instr = self.lines[pc] = Instruction(self.mem[pc], pc)
+            if self.data != None and instr.ctrl != None:
+                instr.load = self.data.loader(instr.ctrl.mask_type)
+                instr.store = self.data.storer(instr.ctrl.mask_type)
+        else:
+            self.hits += 1
+        return instr
+    def invalidate(self, addr, byte_count = 4):
+        "drop every cached instruction word overlapping a store of byte_count bytes at addr"
+        lines = self.lines
+        if not lines:
+            return
+        for pc in range(addr & ~0b11, addr + byte_count, 4):
+            lines.pop(pc, None)
+    def flush(self):
+        "drop all cached instructions (fence.i)"
+        self.lines.clear()
+    def __len__(self):
+        return len(self.lines)
+    def __str__(self):
+        fetches = self.hits + self.misses
+        rate = 100 * self.hits / fetches if fetches else 0
+        return f"Decode cache: {self.hits} hits, {self.misses} misses " \
+               f"({rate:.1f}% hit rate), {len(self)} lines"
+
+# testbench for the decode cache
+if __name__=="__main__":
+    from pydigital.memory import MemorySegment
+    mem = MemorySegment(begin_addr = 0, count = 4, byteorder = 'little')
+    mem[0] = 0x00500093 # addi ra,zero,5
+    mem[4] = 0x00108093 # addi ra,ra,1
+    ic = DecodeCache(mem)
+    for pc in [0, 4, 0, 4]:
+        print(f"{pc:08x}: {ic.fetch(pc)}", end='')
+    mem[4] = 0x00000073 # ecall
+    ic.invalidate(4)
+    print(f"{4:08x}: {ic.fetch(4)}", end='')
+    print(ic)
@@ -1,5 +1,6 @@
 from os import stat
 from .csr_list import csrs
+from .decoder import signals
 from pydigital.utils import sextend
 class BadInstruction(Exception):
     pass
@@ -131,6 +132,9 @@ instr_type = {
     's': ['sb', 'sh', 'sw', 'sd']
 }
 
+# instr type by instr, inverse of the dict above
+instr_format = {name: t for t, names in instr_type.items() for name in names}
+
 class Instruction():
     "represents/decodes RISCV instructions"    
     def __init__ (self, val, pc, symbols = {}):
@@ -157,6 +161,8 @@ class Instruction():
         self.instr = self.get_instr()
         # get the instruction type based on opcode
         self.type = self.get_instr_type()
+        # the precompiled control signals (None if the datapath doesn't support it)
+        self.ctrl = signals.get(self.instr)
         # figure out the rd, rs1, rs2 / immediate values
         if self.type != 's' and self.type != 'sb': # get rd is not s or sb type
             self.rd = self.get_rd()
@@ -234,10 +240,7 @@ class Instruction():
     
     def get_instr_type(self):
         "get the instr type based on the instr"
-        for type in instr_type:
-            for curr in instr_type[type]:
-                if self.instr == curr:
-                    return type
+        return instr_format.get(self.instr)
 
     def check_pseudo(self, rd_str, rs1_str, rs2imm_str):
         "check if the instr is a pseudo instr, if it is replace it"
@@ -292,7 +295,8 @@ class Instruction():
             rd_str = None; rs1_str = None; rs2imm_str = None
 
         # check and replace if pseudo or special instr
-        self.instr, rd_str, rs1_str, rs2imm_str = \
+        # (keep self.instr intact, decoded instructions may be cached and reused)
+        instr, rd_str, rs1_str, rs2imm_str = \
         self.check_pseudo(rd_str, rs1_str, rs2imm_str)
         
         # create the human-readable code string
@@ -304,4 +308,4 @@ class Instruction():
         if rs2imm_str: # if rs2 exist add to output string
             readable.append(rs2imm_str)
 
-        return "{} {}\n".format(self.instr, ",".join(readable))
+        return "{} {}\n".format(instr, ",".join(readable))
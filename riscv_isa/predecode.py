@@ -0,0 +1,104 @@
+"""
+predecode.py
+============
+Vectorized whole-image predecoder (needs numpy).
+
+Every 32-bit word of an image is decoded in one numpy pass into a structured
+array with the opcode, funct3, funct7, register fields, all five immediate
+formats and a mnemonic id (an index into *mnemonics*, 0 if the word is not an
+instruction). Engines and tools can index the table by (pc - base) >> 2
+instead of decoding on each fetch.
+
+numpy is an optional dependency (listed in requirements.txt), the module
+imports without it but predecode raises ImportError, there is no slow
+fallback decoding the image word by word.
+"""
+from elftools.elf.constants import P_FLAGS
+from pydigital.elfloader import Elf
+from .decode_table import mnemonics, keys
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+if np is not None:
+    # one record per instruction word
+    dtype = np.dtype([
+        ('opcode', np.uint8), ('funct3', np.uint8), ('funct7', np.uint8),
+        ('rd', np.uint8), ('rs1', np.uint8), ('rs2', np.uint8),
+        ('mnemonic', np.uint8),
+        ('imm_i', np.int32), ('imm_s', np.int32), ('imm_b', np.int32),
+        ('imm_u', np.int32), ('imm_j', np.int32)])
+
+    # mnemonic id lookup indexed by funct7 << 10 | funct3 << 7 | opcode
+    _lut = np.zeros((128, 8, 128), dtype=np.uint8)
+    for _id, _op, _f3, _f7 in keys:
+        _lut[slice(None) if _f7 is None else _f7,
+             slice(None) if _f3 is None else _f3, _op] = _id
+    _lut = _lut.reshape(-1)
+
+def predecode(data, byteorder = 'little'):
+    "decode every word of the bytes in data, returns a structured array with one record per word"
+    if np is None:
+        raise ImportError("predecode needs numpy, pip install numpy")
+    dt = np.dtype('<u4' if byteorder == 'little' else '>u4')
+    # widen so shifts and masks can't overflow, s is the sign extended word
+    w = np.frombuffer(data, dtype=dt, count=len(data) // 4).astype(np.int64)
+    s = np.where(w & 0x80000000, w - (1 << 32), w)
+
+    table = np.empty(len(w), dtype=dtype)
+    table['opcode'] = opcode = w & 0x7f
+    table['rd'] = rd = w >> 7 & 0x1f
+    table['funct3'] = funct3 = w >> 12 & 0x7
+    table['rs1'] = w >> 15 & 0x1f
+    table['rs2'] = w >> 20 & 0x1f
+    table['funct7'] = funct7 = w >> 25
+    table['mnemonic'] = _lut[funct7 << 10 | funct3 << 7 | opcode]
+
+    # immediates, the sign always comes from bit 31
+    table['imm_i'] = s >> 20
+    table['imm_s'] = (s >> 20) & ~0x1f | rd
+    table['imm_b'] = (s >> 19) & ~0xfff | (w << 4) & 0x800 | \
+                     (w >> 20) & 0x7e0 | (w >> 7) & 0x1e
+    table['imm_u'] = s & ~0xfff
+    table['imm_j'] = (s >> 11) & ~0xfffff | w & 0xff000 | \
+                     (w >> 9) & 0x800 | (w >> 20) & 0x7fe
+    return table
+
+def predecode_elf(elffile):
+    "predecode the executable segments of an elf file, returns a list of (base address, table)"
+    tables = []
+    with Elf(elffile, quiet = True) as e:
+        for segment in e.ef.iter_segments():
+            if segment['p_type'] == 'PT_LOAD' and segment['p_flags'] & P_FLAGS.PF_X:
+                tables.append((segment['p_vaddr'], predecode(segment.data(), e.byteorder)))
+    return tables
+
+# testbench, checks the predecoded tables against Instruction on the riscv-tests
+if __name__=="__main__":
+    import glob, time
+    from .isa import Instruction
+    imm_field = {'i': 'imm_i', 's': 'imm_s', 'sb': 'imm_b', 'u': 'imm_u', 'uj': 'imm_j'}
+    for elffile in sorted(glob.glob('riscv_isa/programs/riscv-test/*')):
+        start = time.perf_counter()
+        tables = predecode_elf(elffile)
+        elapsed = time.perf_counter() - start
+        count = 0
+        for base, table in tables:
+            for idx, rec in enumerate(table):
+                pc = base + 4*idx
+                name = mnemonics[rec['mnemonic']]
+                # rebuild the word from its fields
+                word = int(rec['funct7']) << 25 | int(rec['rs2']) << 20 | int(rec['rs1']) << 15 | \
+                       int(rec['funct3']) << 12 | int(rec['rd']) << 7 | int(rec['opcode'])
+                try:
+                    instr = Instruction(word, pc)
+                except KeyError:
+                    assert name is None, f"{elffile} {pc:08x}: {name}"
+                    continue
+                assert instr.instr == name, f"{elffile} {pc:08x}: {instr.instr} != {name}"
+                if instr.imm is not None:
+                    assert instr.imm == rec[imm_field[instr.type]], f"{elffile} {pc:08x}: {instr}"
+                count += 1
+        print(f"{elffile}: {count} instructions predecoded in {1e3*elapsed:.2f} ms")
@@ -0,0 +1,232 @@
+"""
+simulator.py
+============
+A reusable simulator for driving programs from python.
+
+Unlike onestage_elf.py nothing runs at import time and nothing exits the
+interpreter, so one process can load and run any number of programs:
+
+    sim = Simulator().load_elf('riscv_isa/programs/riscv-test/rv32ui-p-add')
+    result = sim.run(max_instructions = 10**6, timeout = 5)
+    print(result.status, result.exit_code, result.instret)
+
+The program runs on one of the execution engines (functional, blocks or
+jit), the cycle by cycle datapath with its trace stays in onestage_elf.py.
+"""
+import io
+import time
+from collections import namedtuple
+from pydigital.memory import Memory
+from pydigital.register import Register
+from pydigital.elfloader import load_elf
+from regfile import ArrayRegFile
+from htif import HTIF, Halt
+from functional import FunctionalEngine
+from blocks import BlockEngine
+from jit import JitEngine
+from stats import Stats
+from profiler import SamplingProfiler, CallGraphProfiler
+from tracer import TraceBuffer
+import checkpoint
+
+ENGINES = {'functional': FunctionalEngine, 'blocks': BlockEngine, 'jit': JitEngine}
+
+# instructions run between checks of the timeout
+CHUNK = 10000
+
+# status is 'exit' (the guest exited with exit_code), 'end' (ran into the zero
+# word ending the program), 'limit' (max_instructions retired), 'timeout' or
+# 'running' (step returned before any of those), output is the captured output
+Result = namedtuple('Result', ['status', 'exit_code', 'instret', 'pc', 'elapsed', 'output'])
+
+class Simulator:
+    "loads an elf and runs it on one of the execution engines"
+    def __init__(self, engine = 'functional', capture = True, stack_size = 64 * 2**10,
+                 stats = False, profile = None, calls = False, trace = None, trigger = None):
+        """
+        engine is 'functional', 'blocks' or 'jit', capture collects the program
+        output in the result instead of printing it, stats counts the
+        retired instructions in self.stats, profile samples the pc every
+        profile instructions into self.profiler, calls builds the call
+        graph in self.calls, trace is the file a binary trace of the
+        retired instructions is written to and trigger an optional Trigger
+        selecting them (stats and calls need the functional engine, trace
+        the functional or block engine and can't be combined with stats)
+        """
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine {engine}, use one of {', '.join(ENGINES)}")
+        if (stats or calls) and engine != 'functional':
+            raise ValueError("Instruction stats and the call graph need the functional engine")
+        if trace and engine == 'jit':
+            raise ValueError("Tracing needs the functional or block engine")
+        if stats and trace:
+            raise ValueError("Instruction stats and tracing can't be combined")
+        self.collect_stats = stats
+        self.collect_calls = calls
+        self.trace_path = trace
+        self.trace = None
+        self.trigger = trigger
+        self.profile = profile
+        self.engine_name = engine
+        self.capture = capture
+        self.stack_size = stack_size
+        self.path = None
+
+    def load_elf(self, path):
+        "load the elf at path and reset the state to its entry point, returns the simulator"
+        mem, symbols = load_elf(path, stack_size = self.stack_size, quiet = True)
+        self.path = path
+        self.imem = mem
+        self.symbols = symbols
+        self.mem = Memory(mem)
+        self.rf = ArrayRegFile()
+        self.out = io.StringIO() if self.capture else None
+        self.host = HTIF(mem, symbols, path, out = self.out)
+        self.stats = Stats() if self.collect_stats else None
+        self.calls = CallGraphProfiler(path, symbols['_start']) if self.collect_calls else None
+        if self.trace != None:
+            self.trace.close()
+        self.trace = None if self.trace_path == None else TraceBuffer(self.trace_path, path)
+        if self.stats or self.calls or self.trace and self.engine_name == 'functional':
+            self.engine = FunctionalEngine(self.mem, self.rf, self.host, self.stats, self.calls,
+                                           self.trace, self.trigger)
+        elif self.trace:
+            self.engine = BlockEngine(self.mem, self.rf, self.host,
+                                      trace = self.trace, trigger = self.trigger)
+        else:
+            self.engine = ENGINES[self.engine_name](self.mem, self.rf, self.host)
+        self.profiler = None if self.profile == None else SamplingProfiler(path, self.profile)
+        self.next_sample = self.profile
+        self.pc = Register()
+        self.pc.reset(symbols['_start'])
+        self.status = 'running'
+        self.exit_code = None
+        self.elapsed = 0.0
+        return self
+
+    def checkpoint(self, path):
+        "save the machine state to path (gzip compressed if it ends in .gz)"
+        if self.path == None:
+            raise RuntimeError("No program loaded, call load_elf first")
+        checkpoint.save(path, checkpoint.snapshot(self.path, self.pc.out(), self.engine.instret,
+            self.rf.regs, self.engine.csrs, self.imem))
+
+    def restore(self, path):
+        """
+        load the elf a checkpoint was taken from and continue from its state,
+        returns the simulator (stats and profiles count from the restore)
+        """
+        ckpt = checkpoint.load(path)
+        self.load_elf(ckpt.elffile)
+        self.engine.instret = ckpt.instret
+        self.pc.reset(checkpoint.restore(ckpt, self.imem, self.rf, self.engine.csrs, ckpt.instret))
+        if self.profiler != None:
+            self.next_sample = ckpt.instret + self.profile
+        return self
+
+    @property
+    def instret(self):
+        return self.engine.instret
+
+    def read_reg(self, addr):
+        "the unsigned value of register addr"
+        return self.rf.read(addr)
+
+    def write_reg(self, addr, val):
+        "set register addr, x0 stays zero"
+        self.rf.write(addr, val)
+
+    def read_mem(self, addr, size = 4):
+        "the unsigned value of the size bytes of guest memory at addr"
+        return self.imem.load(addr, size)
+
+    def write_mem(self, addr, val, size = 4):
+        "store size bytes of val at addr, dropping any decoded code they overwrite"
+        self.imem.store(addr, val, size)
+        if isinstance(self.engine, FunctionalEngine):
+            self.engine.stored(addr, size)
+        else:
+            self.engine.invalidate(addr, size)
+
+    def step(self, n = 1):
+        "run n instructions (fewer if the program stops first), returns a Result"
+        return self.run(max_instructions = n)
+
+    def run(self, max_instructions = None, timeout = None):
+        """
+        run until the program stops, max_instructions more have retired or
+        timeout seconds have passed, returns a Result
+        """
+        if self.path == None:
+            raise RuntimeError("No program loaded, call load_elf first")
+        if self.status in ('exit', 'end'):
+            return self.result()
+        engine = self.engine
+        stop = None if max_instructions == None else engine.instret + max_instructions
+        start = time.perf_counter()
+        deadline = None if timeout == None else start + timeout
+        self.status = 'running'
+        try:
+            while True:
+                chunk = CHUNK if deadline != None else None
+                if stop != None:
+                    left = stop - engine.instret
+                    if left <= 0:
+                        self.status = 'limit'
+                        break
+                    chunk = left if chunk == None else min(chunk, left)
+                if self.profiler != None:
+                    # stop at the next sample
+                    left = max(self.next_sample - engine.instret, 1)
+                    chunk = left if chunk == None else min(chunk, left)
+                pc = engine.run(self.pc.out(), chunk)
+                if pc == None:
+                    self.status = 'end'
+                    break
+                self.pc.clock(pc)
+                if self.profiler != None and engine.instret >= self.next_sample:
+                    self.profiler.sample(pc)
+                    self.next_sample += self.profile
+                if deadline != None and time.perf_counter() >= deadline:
+                    self.status = 'timeout'
+                    break
+        except Halt as h:
+            self.status = 'exit'
+            self.exit_code = h.code
+            # the engines tag the halt with the pc of the exiting instruction
+            self.pc.clock(getattr(h, 'pc', self.pc.out()))
+        finally:
+            self.elapsed += time.perf_counter() - start
+        if self.calls != None and self.status in ('exit', 'end'):
+            self.calls.finish(engine.instret)
+        if self.trace != None and self.status in ('exit', 'end'):
+            self.trace.close()
+        return self.result()
+
+    def result(self):
+        "the Result for the current state"
+        output = None if self.out == None else self.out.getvalue()
+        return Result(self.status, self.exit_code, self.instret, self.pc.out(),
+                      self.elapsed, output)
+
+# testbench, run each elf given and print its result, then step it on every
+# engine and check each step retires exactly the instructions asked for
+if __name__=="__main__":
+    import sys
+    if len(sys.argv) < 2:
+        exit("ERROR: input elf file not provided!")
+    sim = Simulator()
+    for path in sys.argv[1:]:
+        print(path, sim.load_elf(path).run(timeout = 60))
+        sims = [Simulator(engine).load_elf(path) for engine in ENGINES]
+        instret = 0
+        for k in (1, 2, 3, 5, 8, 13, 100, 1000) * 50:
+            ref = sims[0].step(k)
+            if ref.status != 'limit':
+                break
+            instret += k
+            assert ref.instret == instret, f"functional stepped to {ref.instret}, not {instret}"
+            for s in sims[1:]:
+                r = s.step(k)
+                assert (r.status, r.instret, r.pc) == (ref.status, ref.instret, ref.pc), \
+                    f"{s.engine_name} stepped to {r}, functional to {ref}"
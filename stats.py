@@ -0,0 +1,115 @@
+"""
+stats.py
+========
+Retired instruction statistics for the onestage simulator.
+
+Counting is opt-in and costs one array increment per retired instruction:
+the counters are indexed by the mnemonic id of the decoded instruction
+(decode_table.mnemonics), plus one more increment when a control transfer
+changes the pc. Everything else, the counts per format, per control class
+(alu, load, store, branch taken / not taken, jump, ecall, csr, system) and
+per ALU function, is derived from the mnemonic counts when the summary is
+built, since the mnemonic fixes all of them.
+"""
+import json
+from array import array
+from riscv_isa.decode_table import mnemonics
+from riscv_isa.decoder import signals, renum
+from riscv_isa.isa import instr_format
+
+# mnemonic -> id, for the datapath which decodes with Instruction
+mnemonic_ids = {name: id for id, name in enumerate(mnemonics) if name != None}
+
+# the branch types, BR_JR and BR_J are jumps
+BRANCHES = {2, 3, 4, 5, 7, 8}
+JUMPS = {1, 6}
+
+def control_class(name):
+    "the control class of a mnemonic"
+    ctrl = signals.get(name)
+    if name == 'ecall':
+        return 'ecall'
+    if name.startswith('csr'):
+        return 'csr'
+    if ctrl == None:
+        return 'system'
+    if ctrl.br_type in BRANCHES:
+        return 'branch'
+    if ctrl.br_type in JUMPS:
+        return 'jump'
+    if ctrl.mem_wr:
+        return 'store'
+    if ctrl.wb_sel == 2:
+        return 'load'
+    if ctrl.alu_fun:
+        return 'alu'
+    return 'system'
+
+class Stats:
+    "retired instruction counters indexed by the mnemonic id"
+    def __init__(self):
+        # counts holds the retired instructions, taken the ones that changed the pc
+        self.counts = array('Q', bytes(8 * len(mnemonics)))
+        self.taken = array('Q', bytes(8 * len(mnemonics)))
+
+    # the datapath decodes with Instruction so it counts by mnemonic,
+    # the engines index counts and taken by the decoded id directly
+    def retire(self, name):
+        "count a retired instruction"
+        self.counts[mnemonic_ids[name]] += 1
+
+    def retire_taken(self, name):
+        "count a retired instruction that changed the pc"
+        self.taken[mnemonic_ids[name]] += 1
+
+    def summary(self):
+        "the counts as a dict, total and by mnemonic, format, class and ALU function"
+        by_mnemonic = {}
+        by_format = {}
+        by_class = {}
+        by_alu = {}
+        branches = {'taken': 0, 'not taken': 0}
+        for id, count in enumerate(self.counts):
+            if count == 0:
+                continue
+            name = mnemonics[id]
+            by_mnemonic[name] = count
+            fmt = instr_format.get(name) or 'none'
+            by_format[fmt] = by_format.get(fmt, 0) + count
+            cls = control_class(name)
+            if cls == 'branch':
+                branches['taken'] += self.taken[id]
+                branches['not taken'] += count - self.taken[id]
+            by_class[cls] = by_class.get(cls, 0) + count
+            ctrl = signals.get(name)
+            if ctrl != None and ctrl.alu_fun:
+                alu = renum['ALU_fun'][ctrl.alu_fun]
+                by_alu[alu] = by_alu.get(alu, 0) + count
+        order = lambda d: dict(sorted(d.items(), key = lambda kv: -kv[1]))
+        return {
+            'instret': sum(self.counts),
+            'mnemonic': order(by_mnemonic),
+            'format': order(by_format),
+            'class': order(by_class),
+            'branch': branches,
+            'alu': order(by_alu),
+        }
+
+    def dump_json(self, path):
+        "write the summary as json to path"
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent = 2)
+
+    def table(self):
+        "the summary as a printable table"
+        s = self.summary()
+        total = s['instret'] or 1
+        lines = [f"{s['instret']} instructions retired"]
+        for title in ('class', 'branch', 'format', 'alu', 'mnemonic'):
+            lines.append(f"\n  --- {title.upper()} ---")
+            for key, count in s[title].items():
+                lines.append(f"  {key:12s} {count:12d} {100 * count / total:6.2f}%")
+        return "\n".join(lines)
+
+    def __str__(self):
+        return self.table()
@@ -0,0 +1,205 @@
+"""
+sweep.py
+========
+Fork based fault injection and input sweeps for the onestage simulator.
+
+A Simulator is run to a chosen point once, then fan_out forks a child per
+perturbation (os.fork, so POSIX only). The children share the parent's
+memory, registers and even its decoded / translated code copy-on-write, so
+the common prefix is neither repeated nor copied. Each child applies its
+perturbation (a register or memory word set or a bit flipped, or any
+callable taking the simulator), runs to completion and pickles its Result
+back through a pipe. At most jobs children run at a time.
+
+The command line runs a random single bit flip campaign and classifies each
+run against the unperturbed one: masked (same exit and output), sdc (silent
+data corruption: a different exit code or output), hang (instruction limit
+or timeout) or error (the simulator stopped on a bad instruction, memory
+fault, ...).
+
+usage: python sweep.py elf [-at=N] [-n=count] [-mem] [-seed=S] [-j=N]
+                           [-engine=functional] [-timeout=S]
+"""
+import os, sys, pickle, random, selectors
+from collections import namedtuple
+from simulator import Simulator, Result, ENGINES
+
+# kind is 'reg' (set register target to value), 'reg_flip' (flip bit value of
+# register target), 'mem' (set the word at target) or 'mem_flip'
+Perturbation = namedtuple('Perturbation', ['kind', 'target', 'value'])
+
+def set_reg(n, val):
+    return Perturbation('reg', n, val)
+
+def flip_reg(n, bit):
+    return Perturbation('reg_flip', n, bit)
+
+def set_word(addr, val):
+    return Perturbation('mem', addr, val)
+
+def flip_bit(addr, bit):
+    return Perturbation('mem_flip', addr, bit)
+
+def apply(sim, p):
+    "apply a perturbation (None for none, a Perturbation or a callable) to the simulator"
+    if p == None:
+        return
+    if callable(p):
+        p(sim)
+    elif p.kind == 'reg':
+        sim.write_reg(p.target, p.value)
+    elif p.kind == 'reg_flip':
+        sim.write_reg(p.target, sim.read_reg(p.target) ^ 1 << p.value)
+    elif p.kind == 'mem':
+        sim.write_mem(p.target, p.value)
+    elif p.kind == 'mem_flip':
+        sim.write_mem(p.target, sim.read_mem(p.target) ^ 1 << p.value)
+    else:
+        raise ValueError(f"Unknown perturbation {p.kind}")
+
+def _child(sim, p, max_instructions, timeout):
+    "the run of one forked child, returns the pickled Result"
+    try:
+        apply(sim, p)
+        result = sim.run(max_instructions = max_instructions, timeout = timeout)
+    except Exception as e:
+        result = Result('error', None, sim.instret, sim.pc.out(), sim.elapsed,
+                        f"{type(e).__name__}: {e}")
+    return pickle.dumps(result)
+
+def fan_out(sim, perturbations, max_instructions = None, timeout = None, jobs = None):
+    """
+    fork a child per perturbation from the current state of sim, each runs
+    until it stops, max_instructions more retired or timeout seconds passed,
+    returns their Results in the order of perturbations
+    """
+    if not hasattr(os, 'fork'):
+        raise RuntimeError("fan_out needs os.fork")
+    if sim.trace != None:
+        raise ValueError("The children would share the trace file, fan out without tracing")
+    jobs = jobs or os.cpu_count() or 1
+    results = [None] * len(perturbations)
+    pending = list(enumerate(perturbations))
+    running = {}   # pipe fd -> (index, pid, chunks read)
+    sel = selectors.DefaultSelector()
+    # buffered output would be printed again by every child
+    sys.stdout.flush(); sys.stderr.flush()
+    try:
+        while pending or running:
+            while pending and len(running) < jobs:
+                k, p = pending.pop(0)
+                rfd, wfd = os.pipe()
+                pid = os.fork()
+                if pid == 0:
+                    # the child never returns into the caller
+                    code = 0
+                    try:
+                        os.close(rfd)
+                        data = _child(sim, p, max_instructions, timeout)
+                        with os.fdopen(wfd, 'wb') as f:
+                            f.write(data)
+                    except BaseException:
+                        code = 1
+                    finally:
+                        os._exit(code)
+                os.close(wfd)
+                running[rfd] = (k, pid, [])
+                sel.register(rfd, selectors.EVENT_READ)
+            for key, _ in sel.select():
+                fd = key.fd
+                chunk = os.read(fd, 1 << 16)
+                if chunk:
+                    running[fd][2].append(chunk)
+                    continue
+                # end of file, the child is done
+                sel.unregister(fd)
+                os.close(fd)
+                k, pid, chunks = running.pop(fd)
+                os.waitpid(pid, 0)
+                try:
+                    results[k] = pickle.loads(b"".join(chunks))
+                except Exception:
+                    results[k] = Result('error', None, None, None, 0.0, "the child died")
+    finally:
+        sel.close()
+    return results
+
+def classify(result, golden):
+    "masked, sdc, hang or error, compared to the unperturbed golden Result"
+    if result.status == 'error':
+        return 'error'
+    if result.status in ('limit', 'timeout'):
+        return 'hang'
+    if (result.status, result.exit_code, result.output) == (golden.status, golden.exit_code, golden.output):
+        return 'masked'
+    return 'sdc'
+
+def summarize(results, golden):
+    "the number of runs per outcome, a dict"
+    outcomes = {'masked': 0, 'sdc': 0, 'hang': 0, 'error': 0}
+    for r in results:
+        outcomes[classify(r, golden)] += 1
+    return outcomes
+
+# a random single bit flip campaign
+if __name__=="__main__":
+    args = [a for a in sys.argv[1:] if not a.startswith('-')]
+    if not args:
+        exit("ERROR: input elf file not provided!")
+    path = args[0]
+    at = None
+    count = 100
+    mem = False
+    seed = 0
+    jobs = None
+    engine = 'functional'
+    timeout = None
+    for arg in sys.argv[1:]:
+        if arg.startswith('-at='):
+            at = int(arg.split('=', 1)[1])
+        elif arg.startswith('-n='):
+            count = int(arg.split('=', 1)[1])
+        elif arg == '-mem':
+            mem = True
+        elif arg.startswith('-seed='):
+            seed = int(arg.split('=', 1)[1])
+        elif arg.startswith('-j='):
+            jobs = int(arg.split('=', 1)[1])
+        elif arg.startswith('-engine='):
+            engine = arg.split('=', 1)[1]
+            if engine not in ENGINES:
+                exit(f"ERROR: unknown engine {engine}, use one of {', '.join(ENGINES)}")
+        elif arg.startswith('-timeout='):
+            timeout = float(arg.split('=', 1)[1])
+        elif arg.startswith('-'):
+            exit(f"ERROR: unknown option {arg}")
+
+    golden = Simulator(engine).load_elf(path).run()
+    at = golden.instret // 2 if at == None else at
+    rng = random.Random(seed)
+    sim = Simulator(engine).load_elf(path)
+    if mem:
+        words = [(m.begin_addr, m.end_addr) for m in sim.imem.mems]
+        def pick():
+            lo, hi = rng.choice(words)
+            return flip_bit(rng.randrange(lo, hi) & ~0b11, rng.randrange(32))
+    else:
+        pick = lambda: flip_reg(rng.randrange(1, 32), rng.randrange(32))
+    perturbations = [pick() for _ in range(count)]
+
+    prefix = sim.run(max_instructions = at)
+    if prefix.status != 'limit':
+        exit(f"ERROR: the program stopped ({prefix.status}) before {at} instructions")
+    # a flip that sends the program into a loop is a hang after twice the golden run
+    results = fan_out(sim, perturbations, max_instructions = 2 * golden.instret,
+                      timeout = timeout, jobs = jobs)
+
+    print(f"{path}: {count} {'memory' if mem else 'register'} bit flips after "
+          f"{sim.instret} of {golden.instret} instructions")
+    for outcome, n in summarize(results, golden).items():
+        print(f"  {outcome:8s} {n:6d} {100 * n / (count or 1):6.2f}%")
+    for p, r in zip(perturbations, results):
+        kind = classify(r, golden)
+        if kind != 'masked':
+            where = f"x{p.target}" if p.kind == 'reg_flip' else f"{p.target:08x}"
+            print(f"  {kind:8s} {where} bit {p.value}: {r.status} {r.exit_code}")
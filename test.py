@@ -1,28 +1,142 @@
 """
 test.py
 ========
-Test script to run multiple unit tests on the onestage simulator.
+Test runner for the riscv-tests on the onestage simulator.
+
+Every elf in the test directory (riscv_isa/programs/riscv-test by default)
+runs in-process on a Simulator, spread over a pool of worker processes (one
+per core). Each test gets an instruction limit and a timeout, a test passes
+when the guest exits with code 0.
+
+usage: python test.py [test_dir] [-engine=functional] [-j=N] [-limit=N]
+                      [-timeout=S] [-junit=file.xml] [-json=file.json]
 """
+import os, sys, json, time
+import multiprocessing
+import xml.etree.ElementTree as ET
+from simulator import Simulator, ENGINES
+
+TEST_DIR = os.path.join('riscv_isa', 'programs', 'riscv-test')
+
+# default instructions and seconds a test can run for
+LIMIT = 10**6
+TIMEOUT = 60
+
+def run_test(args):
+    "run one test, returns its result as a dict"
+    path, engine, limit, timeout = args
+    result = {'name': os.path.basename(path), 'path': path, 'engine': engine}
+    start = time.perf_counter()
+    try:
+        r = Simulator(engine).load_elf(path).run(max_instructions = limit, timeout = timeout)
+    except Exception as e:
+        # a bad instruction or a simulator bug, keep the other tests going
+        result.update(passed = False, status = 'error', exit_code = None, instret = None,
+                      time = time.perf_counter() - start, output = f"{type(e).__name__}: {e}")
+        return result
+    result.update(passed = r.status == 'exit' and r.exit_code == 0, status = r.status,
+                  exit_code = r.exit_code, instret = r.instret,
+                  time = time.perf_counter() - start, output = r.output)
+    return result
+
+def run_tests(paths, engine = 'functional', jobs = None, limit = LIMIT, timeout = TIMEOUT):
+    "run the tests at paths on a pool of jobs processes, returns the results in order"
+    jobs = jobs or os.cpu_count() or 1
+    args = [(path, engine, limit, timeout) for path in paths]
+    if jobs == 1:
+        return [run_test(a) for a in args]
+    with multiprocessing.Pool(min(jobs, len(args)) or 1) as pool:
+        return pool.map(run_test, args, chunksize = 1)
+
+def describe(result):
+    "why a test failed"
+    status = result['status']
+    if status == 'exit':
+        # riscv-tests exit with the failing test number << 1 | 1
+        code = result['exit_code']
+        return f"exit code {code}" + (f" (test {code >> 1})" if code & 1 else '')
+    if status == 'limit':
+        return f"instruction limit reached ({result['instret']} retired)"
+    if status == 'timeout':
+        return "timed out"
+    if status == 'end':
+        return "ran off the end of the program"
+    return result['output']
 
-import os, sys
+def write_junit(results, path, engine):
+    "write the results as a JUnit XML report"
+    failures = sum(1 for r in results if not r['passed'] and r['status'] != 'error')
+    errors = sum(1 for r in results if r['status'] == 'error')
+    suite = ET.Element('testsuite', name = f"riscv-tests.{engine}", tests = str(len(results)),
+                       failures = str(failures), errors = str(errors),
+                       time = f"{sum(r['time'] for r in results):.3f}")
+    for r in results:
+        case = ET.SubElement(suite, 'testcase', classname = f"riscv-tests.{engine}",
+                             name = r['name'], time = f"{r['time']:.3f}")
+        if not r['passed']:
+            tag = 'error' if r['status'] == 'error' else 'failure'
+            ET.SubElement(case, tag, message = describe(r), type = r['status'])
+        if r['output']:
+            ET.SubElement(case, 'system-out').text = r['output']
+    ET.ElementTree(suite).write(path, encoding = 'utf-8', xml_declaration = True)
 
-# check if a path was provided
-if len(sys.argv) < 2:
-    exit("ERROR: test directory path not provided!")
+def write_json(results, path, engine):
+    "write the results and a summary as json"
+    report = {
+        'engine': engine,
+        'tests': len(results),
+        'passed': sum(1 for r in results if r['passed']),
+        'failed': sum(1 for r in results if not r['passed']),
+        'results': results,
+    }
+    with open(path, 'w') as f:
+        json.dump(report, f, indent = 2)
 
-# get the inputted test directory path
-test_dir = sys.argv[1]
+if __name__=="__main__":
+    test_dir = TEST_DIR
+    engine = 'functional'
+    jobs = None
+    limit = LIMIT
+    timeout = TIMEOUT
+    junit = json_file = None
+    for arg in sys.argv[1:]:
+        if arg.startswith('-engine='):
+            engine = arg.split('=', 1)[1]
+            if engine not in ENGINES:
+                exit(f"ERROR: unknown engine {engine}, use one of {', '.join(ENGINES)}")
+        elif arg.startswith('-j='):
+            jobs = int(arg.split('=', 1)[1])
+        elif arg.startswith('-limit='):
+            limit = int(arg.split('=', 1)[1]) or None
+        elif arg.startswith('-timeout='):
+            timeout = float(arg.split('=', 1)[1]) or None
+        elif arg.startswith('-junit='):
+            junit = arg.split('=', 1)[1]
+        elif arg.startswith('-json='):
+            json_file = arg.split('=', 1)[1]
+        elif arg.startswith('-'):
+            exit(f"ERROR: unknown option {arg}")
+        else:
+            test_dir = arg
 
-# fix formatting
-if not test_dir.endswith("\\"): test_dir += "\\"
+    # check if path is a directory
+    if not os.path.isdir(test_dir):
+        exit("ERROR: provided path is not a directory")
 
-# check if path is a directory
-if not os.path.isdir(test_dir):
-    exit("ERROR: provided path is not a directory")
+    paths = [os.path.join(test_dir, f) for f in sorted(os.listdir(test_dir))
+             if os.path.isfile(os.path.join(test_dir, f))]
+    start = time.perf_counter()
+    results = run_tests(paths, engine, jobs, limit, timeout)
+    elapsed = time.perf_counter() - start
 
-# loop through files in the test directory
-for elf_file in os.listdir(test_dir):
-    # execute the test for each elf file
-    print(f"TESTING: --- {elf_file}")
-    os.system(f"python onestage_elf.py {test_dir}{elf_file} -t -s")
+    for r in results:
+        if r['passed']:
+            print(f"PASS: {r['name']:24s} {r['instret']:8d} instructions {r['time']:7.3f} s")
+        else:
+            print(f"FAIL: {r['name']:24s} {describe(r)}")
+    failed = [r['name'] for r in results if not r['passed']]
+    print(f"{len(results) - len(failed)}/{len(results)} passed on {engine} in {elapsed:.2f} s")
 
+    if junit: write_junit(results, junit, engine)
+    if json_file: write_json(results, json_file, engine)
+    if failed: exit(1)
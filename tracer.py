@@ -0,0 +1,243 @@
+"""
+tracer.py
+=========
+Binary execution traces for the onestage simulator.
+
+Tracing writes one fixed size record per retired instruction (the pc, the
+instruction word, the value written to rd and the memory address of a load
+or store) into a preallocated ring buffer. A full buffer is written to the
+trace file in one go, gzip compressed when the file name ends in .gz. Without
+a file the buffer just wraps and keeps the last records, for a look at what
+happened right before a failure.
+
+A Trigger narrows the trace down: start at a pc (an elf symbol) and stop
+when that call returns, stop after a number of instructions or only trace
+inside an address window. The block engine resolves the trigger per block,
+blocks that can't start or be inside a trace run untraced at full speed.
+
+Nothing is formatted while the program runs. This module is also the
+offline decoder, it renders a trace in the format of the datapath debug
+output with the disassembly and the symbol of each pc:
+
+    python tracer.py trace.bin [elf] [-n=count] [-skip=count]
+"""
+import sys, gzip, struct
+from riscv_isa.isa import Instruction
+from profiler import SymbolTable
+
+MAGIC = b'RVTR'
+VERSION = 1
+# header: magic, version, record size, length of the elf path that follows
+HEADER = struct.Struct('<4sHHH')
+# pc, instruction word, rd value, memory address
+RECORD = struct.Struct('<IIII')
+# records held by the buffer
+RECORDS = 1 << 16
+MASK = 0xffffffff
+
+def _open(path, mode):
+    "open a trace file, gzip streamed if it ends in .gz"
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+class TraceBuffer:
+    "ring buffer of trace records, flushed in bulk to a file"
+    def __init__(self, path = None, elffile = '', records = RECORDS):
+        """
+        path is the trace file (None to only keep the last records in memory),
+        elffile the traced program, saved so the decoder can find its symbols,
+        and records the size of the buffer
+        """
+        self.path = path
+        self.elffile = elffile
+        self.buf = bytearray(RECORD.size * records)
+        self.end = len(self.buf)
+        self.pos = 0
+        self.total = 0       # records written, including the flushed ones
+        self.wrapped = False
+        self.pack = RECORD.pack_into
+        self.size = RECORD.size
+        self.f = None
+        if path != None:
+            self.f = _open(path, 'wb')
+            self.write_header(self.f)
+
+    def write_header(self, f):
+        name = self.elffile.encode()
+        f.write(HEADER.pack(MAGIC, VERSION, RECORD.size, len(name)) + name)
+
+    def record(self, pc, word, rd_val, addr):
+        "append one record, the values are unsigned 32-bit"
+        pos = self.pos
+        self.pack(self.buf, pos, pc, word, rd_val & MASK, addr & MASK)
+        pos += self.size
+        if pos == self.end:
+            self.flush(pos)
+            pos = 0
+        self.pos = pos
+        self.total += 1
+
+    def flush(self, pos = None):
+        "write the buffered records to the file, or wrap around without one"
+        pos = self.pos if pos == None else pos
+        if self.f != None:
+            self.f.write(memoryview(self.buf)[:pos])
+        elif pos == self.end:
+            self.wrapped = True
+        if self.f != None or pos == self.end:
+            self.pos = 0
+
+    def records(self):
+        "the buffered records, oldest first, as a list of (pc, word, rd value, address)"
+        data = self.buf[self.pos:] + self.buf[:self.pos] if self.wrapped else self.buf[:self.pos]
+        return list(RECORD.iter_unpack(data))
+
+    def dump(self, path):
+        "save the buffered records as a trace file"
+        with _open(path, 'wb') as f:
+            self.write_header(f)
+            for rec in self.records():
+                f.write(RECORD.pack(*rec))
+
+    def close(self):
+        "flush and close the trace file"
+        if self.f != None:
+            self.flush()
+            self.f.close()
+            self.f = None
+
+class Trigger:
+    "decides which retired instructions are traced"
+    def __init__(self, start = None, count = None, window = None):
+        """
+        start is the pc tracing starts at, it stops when the call returns to
+        the ra it was entered with (and starts again on the next entry),
+        count the most instructions traced and window a (lo, hi) address
+        range outside of which nothing is traced, None for no limit
+        """
+        self.start = start
+        self.count = count
+        self.window = window
+        self.tracking = False   # between start and its return
+        self.until = None       # the return address that stops tracking
+
+    @property
+    def done(self):
+        "true once count instructions were traced"
+        return self.count == 0
+
+    def covers(self, lo, hi):
+        "whether an instruction in [lo, hi) can be traced while not tracking"
+        if self.done:
+            return False
+        if self.start != None:
+            return lo <= self.start < hi
+        if self.window != None:
+            return lo < self.window[1] and self.window[0] < hi
+        return True
+
+    def check(self, pc, ra):
+        "whether the instruction at pc is traced, ra is the return address register"
+        if self.count == 0:
+            return False
+        if self.start != None:
+            if self.tracking and pc == self.until:
+                self.tracking = False
+            if not self.tracking:
+                if pc != self.start:
+                    return False
+                self.tracking = True
+                self.until = ra & MASK
+        if self.window != None and not self.window[0] <= pc < self.window[1]:
+            return False
+        if self.count != None:
+            self.count -= 1
+            if self.count == 0:
+                self.tracking = False
+        return True
+
+def resolve(spec, symbols):
+    "the address of spec, an elf symbol or a number"
+    if spec in symbols:
+        return symbols[spec]
+    try:
+        return int(spec, 0)
+    except ValueError:
+        raise ValueError(f"{spec} is neither a symbol nor an address")
+
+def parse_window(spec, symbols, elffile):
+    "the (lo, hi) range of spec, lo:hi (symbols or numbers) or the extent of a function"
+    if ':' in spec:
+        lo, hi = spec.split(':', 1)
+        return resolve(lo, symbols), resolve(hi, symbols)
+    for addr, size, name in SymbolTable(elffile).funcs:
+        if name == spec and size:
+            return addr, addr + size
+    raise ValueError(f"{spec} is not a function with a size")
+
+def read_trace(path):
+    "read a trace file, returns the elf path saved in it and an iterator over its records"
+    f = _open(path, 'rb')
+    magic, version, size, length = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or size != RECORD.size:
+        f.close()
+        raise ValueError(f"{path} is not a version {VERSION} trace file")
+    elffile = f.read(length).decode()
+    def records():
+        with f:
+            while True:
+                chunk = f.read(RECORD.size * 4096)
+                if not chunk:
+                    break
+                yield from RECORD.iter_unpack(chunk[:len(chunk) - len(chunk) % RECORD.size])
+    return elffile, records()
+
+def render(records, symbols = None, start = 0, out = sys.stdout):
+    """
+    print records in the datapath debug format, symbols is an optional
+    SymbolTable naming the function of each pc and start the number of the
+    first record
+    """
+    decoded = {}
+    for n, (pc, word, rd_val, addr) in enumerate(records, start + 1):
+        instr = decoded.get((pc, word))
+        if instr == None:
+            try:
+                instr = decoded[pc, word] = Instruction(word, pc)
+            except KeyError:
+                instr = decoded[pc, word] = None
+        where = f" <{symbols.lookup(pc)}>" if symbols != None else ""
+        if instr == None:
+            print(f"{n}: PC: {pc:08x}, IR: {word:08x}, ???{where}\n", file=out)
+            continue
+        ctrl = instr.ctrl
+        rd_str = f"rd: {rd_val:x} [{instr.rd}]" if instr.rd else "rd: xxxxxxxx [xx]"
+        mem_str = f" mem: {addr:08x}" if ctrl != None and ctrl.mem_em else ""
+        print(f"{n}: PC: {pc:08x}, IR: {word:08x}, {instr}{rd_str}{mem_str}{where}\n", file=out)
+
+# the offline decoder
+if __name__=="__main__":
+    from itertools import islice
+    args = [a for a in sys.argv[1:] if not a.startswith('-')]
+    if not args:
+        exit("ERROR: trace file not provided!")
+    count = skip = 0
+    for arg in sys.argv[1:]:
+        if arg.startswith('-n='):
+            count = int(arg.split('=', 1)[1])
+        elif arg.startswith('-skip='):
+            skip = int(arg.split('=', 1)[1])
+    elffile, records = read_trace(args[0])
+    elffile = args[1] if len(args) > 1 else elffile
+    symbols = None
+    if elffile:
+        try:
+            symbols = SymbolTable(elffile)
+        except OSError:
+            print(f"WARNING: can't read {elffile}, no symbols", file=sys.stderr)
+    records = islice(records, skip, skip + count if count else None)
+    try:
+        render(records, symbols, skip)
+    except BrokenPipeError:
+        pass